@@ -1,35 +1,90 @@
+import hashlib
+import itertools
 import os
 import random
-import requests
 import sys
-import sqlite3
-from PIL import Image
-import io
 import shutil
 import base64
-from transformers import pipeline
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from aesthetic import AestheticEvaluator, ScoreCache
+from best_of_n import BestOfNSampler
+from crossfade import crossfade_frames, write_frames
+from image_store import ImageRepository
+from metrics import metrics
+from render_cache import RenderCache
+from sd_client import SDError
+from sd_images import PNGWriter, decode_image, decode_images
+from sd_scheduler import SDScheduler
+
+# Renders with a fixed seed are cached on disk, so re-running the same prompts costs no SD time
+sd_client = RenderCache(
+    SDScheduler.from_env(),
+    db_path=os.environ.get("RENDER_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "render_cache.sqlite")),
+    max_bytes=int(os.environ.get("RENDER_CACHE_MAX_MB", 2048)) * 1024 * 1024,
+)
 
-class AestheticEvaluator:
-    def __init__(self):
-        self.pipe = pipeline("image-classification", model="cafeai/cafe_aesthetic")
-
-    def evaluate_aesthetic(self, image_path):
-        result = self.pipe(image_path)
-        return result[0]['score']
 
 class AdvancedImageGenerator:
-    def __init__(self):
-        self.aesthetic_evaluator = AestheticEvaluator()
+    # Candidate seeds are derived from `seed`, the prompt and the candidate number, so
+    # the same run renders the same images (and hits the render cache); change `seed`
+    # for a fresh set
+    def __init__(self, seed=0):
+        self.seed = seed
         current_directory = os.path.dirname(os.path.abspath(__file__))
         db_path = os.path.join(current_directory, 'image_db.sqlite')
-        self.conn = sqlite3.connect(db_path)
-        self.c = self.conn.cursor()
-        self.c.execute('''CREATE TABLE IF NOT EXISTS images (prompt TEXT, filename TEXT, aesthetic_score REAL)''')
-        self.conn.commit()
+        self.store = ImageRepository(db_path)
+        self.score_cache = ScoreCache(db_path)
+        self.aesthetic_evaluator = AestheticEvaluator(cache=self.score_cache)
+        self.png_writer = PNGWriter()
 
     def close(self):
-        if self.conn:
-            self.conn.close()
+        self.png_writer.close()
+        print(f"Aesthetic score cache: {self.score_cache.stats()}")
+        print(f"Render cache: {sd_client.stats()}")
+        print(f"Stage timings: {metrics.snapshot()['stages']}")
+        self.score_cache.close()
+        self.store.close()
+
+    def candidate_seed(self, message, index):
+        digest = hashlib.blake2b(f"{self.seed}:{message}:{index}".encode("utf-8"), digest_size=4).digest()
+        return int.from_bytes(digest, "big")
+
+    def render_one(self, message, seed=None):
+        payload = {
+            "prompt": message,
+            "steps": 9,
+            "seed": random.randrange(sys.maxsize) if seed is None else seed,
+            "width": 333,
+            "height": 411,
+        }
+        r = sd_client.txt2img(payload)
+        return decode_images(r)
+
+    def render_candidates(self, message, num_images=5):
+        # Send the renders together so the scheduler can spread them over all SD backends
+        with ThreadPoolExecutor(max_workers=num_images) as pool:
+            futures = [pool.submit(self.render_one, message, self.candidate_seed(message, i)) for i in range(num_images)]
+
+        images = []
+        for future in futures:
+            try:
+                images += future.result()
+            except SDError as e:
+                print("Error generating image: ", e)
+        return images
+
+    # Score all candidates in one classifier batch, save them in the background and
+    # record the scores. Call self.png_writer.flush() before reading the files back.
+    def score_and_store(self, message, images, output_directory):
+        scores = self.aesthetic_evaluator.evaluate_batch([image.image for image in images])
+        results = []
+        for i, (image, aesthetic_score) in enumerate(zip(images, scores)):
+            random_suffix = str(random.randint(1, 1000))  # Randomized filename suffix
+            filename = os.path.join(output_directory, f"{message}_{i}_{random_suffix}.png")
+            self.png_writer.write(filename, image)
+            self.store.add_image(message, filename, aesthetic_score)
+            results.append((filename, aesthetic_score))
+        return results
 
     def generate_images(self, message, num_images=5, output_directory=None):
         generated_images = []
@@ -38,53 +93,41 @@ class AdvancedImageGenerator:
 
         os.makedirs(output_directory, exist_ok=True)
 
-        for _ in range(num_images):
-            url = 'http://127.0.0.1:7860/sdapi/v1/txt2img'
-            payload = {
-                "prompt": message,
-                "steps": 9,
-                "seed": random.randrange(sys.maxsize),
-                "width": 333,
-                "height": 411,
-            }
-            response = requests.post(url, json=payload)
-            if response.status_code == 200:
-                r = response.json()
-                for i, img_data in enumerate(r['images']):
-                    image = Image.open(io.BytesIO(base64.b64decode(img_data.split(",", 1)[0])))
-                    random_suffix = str(random.randint(1, 1000))  # Randomized filename suffix
-                    filename = os.path.join(output_directory, f"{message}_{i}_{random_suffix}.png")
-                    image.save(filename)
-
-                    aesthetic_score = self.aesthetic_evaluator.evaluate_aesthetic(filename)
-                    self.c.execute("INSERT INTO images VALUES (?, ?, ?)", (message, filename, aesthetic_score))
-                    self.conn.commit()
-
-                    if aesthetic_score > 0.7:
-                        print(f"High aesthetic score: {filename}, Score: {aesthetic_score}")
-                        generated_images.append(filename)
-            else:
-                print("Error generating image: ", response.status_code)
+        images = self.render_candidates(message, num_images)
+        for filename, aesthetic_score in self.score_and_store(message, images, output_directory):
+            if aesthetic_score > 0.7:
+                print(f"High aesthetic score: {filename}, Score: {aesthetic_score}")
+                generated_images.append(filename)
 
+        self.png_writer.flush()
         return generated_images
 
+    def generate_best_aesthetic_image(self, message, num_attempts=5, num_images=5, target_score=0.9):
+        output_directory = "output_images_" + str(random.randint(1, 1000))  # Randomized output directory
+        os.makedirs(output_directory, exist_ok=True)
 
-    def generate_best_aesthetic_image(self, message, num_attempts=5):
-        best_image = None
-        best_score = 0
-        for _ in range(num_attempts):
-            generated_images = self.generate_images(message)
-            for filename in generated_images:
-                self.c.execute("SELECT aesthetic_score FROM images WHERE filename=?", (filename,))
-                score = self.c.fetchone()[0]
-                if score > best_score:
-                    best_score = score
-                    best_image = filename
+        # Same render budget as num_attempts rounds of num_images, but stop as soon as
+        # a candidate reaches target_score
+        candidates = itertools.count()
+        sampler = BestOfNSampler(
+            render=lambda: self.render_one(message, self.candidate_seed(message, next(candidates))),
+            score=lambda images: self.score_and_store(message, images, output_directory),
+            target_score=target_score,
+            budget=num_attempts * num_images,
+            concurrency=num_images,
+        )
+        best_image, best_score, stats = sampler.sample()
+        print(f"Best-of-N for {message}: {stats}")
+        self.png_writer.flush()
+
+        if best_score is None or best_score <= 0.7:
+            return None, 0
+        print(f"High aesthetic score: {best_image}, Score: {best_score}")
         return best_image, best_score
 
-    def interpolate_images(self, initial_message, final_message, output_folder, num_frames=50):
-        os.makedirs(output_folder, exist_ok=True)
-
+    # Crossfade between the best images for two prompts. Frames go to PNGs in
+    # output_folder, or to `sink.write(frame)` (e.g. a video encoder) when given.
+    def interpolate_images(self, initial_message, final_message, output_folder, num_frames=50, easing="linear", sink=None):
         initial_image, _ = self.generate_best_aesthetic_image(initial_message)
         final_image, _ = self.generate_best_aesthetic_image(final_message)
 
@@ -92,50 +135,71 @@ class AdvancedImageGenerator:
             print("Failed to generate initial or final images for interpolation.")
             return
 
-        for frame_number in range(num_frames):
-            ratio = frame_number / (num_frames - 1)
-            blended_image = Image.blend(Image.open(initial_image), Image.open(final_image), ratio)
-            filename = os.path.join(output_folder, f"interpolation_{frame_number:03d}.png")
-            blended_image.save(filename)
-        print(f"Generated {num_frames} interpolation frames in {output_folder}")
-
-def generate_intermediate_frames(self, image_path, output_folder, num_frames=50):
-    os.makedirs(output_folder, exist_ok=True)
-
-    if num_frames == 1:
-        # Special case when num_frames is 1
-        ratio = 0.5  # You can choose any ratio you want
-        filename = os.path.join(output_folder, "intermediate_000.png")
-
-        url = 'http://127.0.0.1:7860/sdapi/v1/img2img'
-        options = {
-            'init_images': [image_path],
-            'ratio': ratio  # Adjust the transformation ratio
-        }
-        response = requests.post(url, json=options)
-        if 'images' in response.json():
-            img_data = response.json()['images'][0]
-            image = Image.open(io.BytesIO(base64.b64decode(img_data.split(",", 1)[0])))
-            image.save(filename)
+        frames = crossfade_frames(initial_image, final_image, num_frames, easing=easing)
+        if sink is not None:
+            for frame in frames:
+                sink.write(frame)
+            print(f"Streamed {num_frames} interpolation frames")
         else:
-            print(f"No images received from img2img API for frame 0")
-    else:
-        for frame_number in range(num_frames):
-            ratio = frame_number / (num_frames - 1)
-            filename = os.path.join(output_folder, f"intermediate_{frame_number:03d}.png")
-
-            url = 'http://127.0.0.1:7860/sdapi/v1/img2img'
+            write_frames(frames, output_folder)
+            print(f"Generated {num_frames} interpolation frames in {output_folder}")
+
+    # img2img variations of image_path, yielded as (frame_number, image) as they
+    # arrive rather than in frame order. Frame n is rendered at denoising strength
+    # ratios[n] (by default evenly spaced from 0 to 1 over num_frames). Frames with
+    # the same ratio share requests of up to batch_size * n_iter images and up to
+    # `concurrency` requests are in flight at once. Frames are also saved to
+    # output_folder when given.
+    def generate_intermediate_frames(self, image_path, output_folder=None, num_frames=50, ratios=None,
+                                     batch_size=4, n_iter=1, concurrency=4):
+        if ratios is None:
+            ratios = [0.5] if num_frames == 1 else [n / (num_frames - 1) for n in range(num_frames)]
+        if output_folder is not None:
+            os.makedirs(output_folder, exist_ok=True)
+
+        # Read and encode the init image once for every request
+        with open(image_path, "rb") as f:
+            init_image = base64.b64encode(f.read()).decode("ascii")
+
+        by_ratio = {}
+        for frame_number, ratio in enumerate(ratios):
+            by_ratio.setdefault(ratio, []).append(frame_number)
+        per_request = batch_size * n_iter
+        requests = [(ratio, frame_numbers[i:i + per_request])
+                    for ratio, frame_numbers in by_ratio.items()
+                    for i in range(0, len(frame_numbers), per_request)]
+
+        def render(ratio, frame_numbers):
+            count = len(frame_numbers)
+            batch = min(batch_size, count)
             options = {
-                'init_images': [image_path],
-                'ratio': ratio  # Adjust the transformation ratio
+                'init_images': [init_image],
+                'denoising_strength': ratio,
+                'batch_size': batch,
+                'n_iter': -(-count // batch),
+                'seed': self.candidate_seed(f"{image_path}:{ratio}", frame_numbers[0]),
             }
-            response = requests.post(url, json=options)
-            if 'images' in response.json():
-                img_data = response.json()['images'][0]
-                image = Image.open(io.BytesIO(base64.b64decode(img_data.split(",", 1)[0])))
-                image.save(filename)
-            else:
-                print(f"No images received from img2img API for frame {frame_number}")
+            r = sd_client.img2img(options)
+            # A batch may come back with a grid image first; the frames are the last ones
+            return [decode_image(img_data) for img_data in r.get('images', [])[-count:]]
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = {pool.submit(render, ratio, frame_numbers): frame_numbers for ratio, frame_numbers in requests}
+            for future in as_completed(futures):
+                frame_numbers = futures[future]
+                try:
+                    images = future.result()
+                except SDError as e:
+                    print(f"img2img failed for frames {frame_numbers[0]}-{frame_numbers[-1]}: {e}")
+                    continue
+                if len(images) < len(frame_numbers):
+                    print(f"img2img returned {len(images)} of {len(frame_numbers)} images for frames {frame_numbers[0]}-{frame_numbers[-1]}")
+                for frame_number, image in zip(frame_numbers, images):
+                    if output_folder is not None:
+                        self.png_writer.write(os.path.join(output_folder, f"intermediate_{frame_number:03d}.png"), image)
+                    yield frame_number, image.image
+        self.png_writer.flush()
+
 
 if __name__ == "__main__":
     generator = AdvancedImageGenerator()
@@ -154,8 +218,8 @@ if __name__ == "__main__":
     shutil.copy("output_folder2/interpolation_000.png", "output_folder1/")
 
     # Apply img2img transformations for each frame in the interpolation
-    for frame_number in range(200):
-        generator.generate_intermediate_frames(image1, f"intermediate_frames_{frame_number:03d}", num_frames=1)
+    for frame_number, _ in generator.generate_intermediate_frames(image1, "intermediate_frames", ratios=[0.5] * 200):
+        print(f"Intermediate frame {frame_number} done")
 
     generator.close()
 
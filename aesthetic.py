@@ -0,0 +1,79 @@
+import hashlib
+
+from PIL import Image
+
+from metrics import metrics
+from model_loader import LazyModel
+from sqlite_lru import SQLiteLRU
+
+AESTHETIC_MODEL = "cafeai/cafe_aesthetic"
+
+
+# Hash of the decoded pixels, so the same image gives the same key whether it
+# arrives from an SD response or is read back from a PNG
+def image_hash(image):
+    if isinstance(image, str):
+        with Image.open(image) as opened:
+            return image_hash(opened)
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(image)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+class ScoreCache(SQLiteLRU):
+    """Aesthetic scores keyed by (image hash, model id), in an `aesthetic_scores` table."""
+
+    def __init__(self, db_path, max_entries=4096):
+        super().__init__(db_path, "aesthetic_scores", ["image_hash", "model"], "score", "REAL", max_entries=max_entries)
+
+    def get(self, image_hash, model):
+        return super().get((image_hash, model))
+
+    def put_many(self, entries, model):
+        with metrics.timer("sqlite_score_write"):
+            super().put_many([((image_hash, model), score) for image_hash, score in entries])
+
+
+class AestheticEvaluator:
+    def __init__(self, model=AESTHETIC_MODEL, batch_size=8, cache=None):
+        self.model = model
+        self.batch_size = batch_size
+        self.cache = cache
+        # transformers and the model are only loaded once something is scored
+        self.pipe = LazyModel(self._load_pipeline, name=model)
+
+    def _load_pipeline(self):
+        from transformers import pipeline
+        return pipeline("image-classification", model=self.model)
+
+    def evaluate_aesthetic(self, image_path):
+        return self.evaluate_batch([image_path])[0]
+
+    # Score many images in one pass through the classifier. `images` may hold PIL
+    # images, decoded HxWxC uint8 arrays or file paths; scores come back in the
+    # same order. Images already in the cache skip the classifier.
+    def evaluate_batch(self, images, batch_size=None):
+        if not images:
+            return []
+        inputs = [image if isinstance(image, (str, Image.Image)) else Image.fromarray(image) for image in images]
+        if self.cache is None:
+            return self._classify(inputs, batch_size)
+
+        keys = [image_hash(image) for image in inputs]
+        scores = [self.cache.get(key, self.model) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        if missing:
+            fresh = self._classify([inputs[i] for i in missing], batch_size)
+            for i, score in zip(missing, fresh):
+                scores[i] = score
+            self.cache.put_many([(keys[i], scores[i]) for i in missing], self.model)
+        return scores
+
+    def _classify(self, inputs, batch_size=None):
+        with metrics.timer("aesthetic_classify", images=len(inputs)):
+            results = self.pipe(inputs, batch_size=batch_size or self.batch_size)
+        metrics.inc("aesthetic_images", len(inputs))
+        return [result[0]['score'] for result in results]
@@ -0,0 +1,155 @@
+"""Make many movies (or best-of-N images) in one process.
+
+Topics come one per line from a file, or from stdin with "-"; blank lines,
+lines starting with # and repeated topics are skipped. The Llama model, aesthetic pipeline, SD
+connections and caches are loaded once and shared, and several movies run at
+once so their frames interleave: the inference service takes Llama calls
+round-robin across movies and the SD scheduler keeps every backend busy.
+
+    python batch_movies.py topics.txt --concurrency 4 --summary batch_summary.json
+    python batch_movies.py prompts.txt --kind image
+
+One JSON summary with a result per topic and movies/hour is written at the end.
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def read_topics(source):
+    f = sys.stdin if source == "-" else open(source, encoding="utf-8")
+    try:
+        topics = [line.strip() for line in f]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    # A topic listed twice would make two runs fight over one movie folder
+    return list(dict.fromkeys(topic for topic in topics if topic and not topic.startswith("#")))
+
+
+def load_script(filename, name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(script_dir, filename))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# Movies through mode-goat.py's make_movie, `concurrency` at a time
+async def run_movies(topics, args):
+    mode_goat = load_script("mode-goat.py", "mode_goat")
+    await asyncio.gather(*(model.ensure_loaded() for model in mode_goat.models))
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def run(topic):
+        async with slots:
+            started = time.monotonic()
+            result = {"topic": topic}
+            try:
+                movie = await mode_goat.make_movie(topic, args.pipeline_depth, args.save_every, resume=not args.no_resume,
+                                                   total_frames=args.total_frames, keyframe_every=args.keyframe_every,
+                                                   tween=args.tween)
+                result.update(status="done", movie_path=movie["movie_path"])
+            except Exception as e:
+                logging.error(f"Movie {topic} failed: {e}")
+                result.update(status="failed", error=str(e))
+            result["seconds"] = time.monotonic() - started
+            print(f"{topic}: {result['status']} in {result['seconds']:.0f}s")
+            return result
+
+    try:
+        return await asyncio.gather(*(run(topic) for topic in topics)), {
+            "inference": mode_goat.inference.stats(),
+            "render_cache": mode_goat.sd_client.stats(),
+        }
+    finally:
+        mode_goat.inference.close()
+
+
+# Best-of-N images through the Cafe script, sharing one aesthetic pipeline
+def run_images(prompts, args):
+    cafe = load_script("Cafe.Aesthetic.Stable.Diffusion.Interpolation.Video.py", "cafe")
+    generator = cafe.AdvancedImageGenerator()
+
+    def run(prompt):
+        started = time.monotonic()
+        result = {"topic": prompt}
+        try:
+            image, score = generator.generate_best_aesthetic_image(prompt, target_score=args.target_score)
+            if image:
+                result.update(status="done", image=image, score=score)
+            else:
+                result.update(status="failed", error="No image reached the aesthetic threshold")
+        except Exception as e:
+            logging.error(f"Image for {prompt} failed: {e}")
+            result.update(status="failed", error=str(e))
+        result["seconds"] = time.monotonic() - started
+        print(f"{prompt}: {result['status']} in {result['seconds']:.0f}s")
+        return result
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(run, prompts))
+        return results, {
+            "aesthetic_cache": generator.score_cache.stats(),
+            "render_cache": cafe.sd_client.stats(),
+        }
+    finally:
+        generator.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("topics", help='file with one topic per line, or "-" for stdin')
+    parser.add_argument("--kind", choices=["movie", "image"], default="movie")
+    parser.add_argument("--concurrency", type=int, default=4, help="movies (or images) in progress at once")
+    parser.add_argument("--summary", default="batch_summary.json")
+    parser.add_argument("--pipeline-depth", type=int, default=2)
+    parser.add_argument("--save-every", type=int, default=1)
+    parser.add_argument("--total-frames", type=int, default=50)
+    parser.add_argument("--keyframe-every", type=int, default=1)
+    parser.add_argument("--tween", default="linear")
+    parser.add_argument("--no-resume", action="store_true", help="start movies over instead of resuming them")
+    parser.add_argument("--target-score", type=float, default=0.9, help="image: stop searching at this aesthetic score")
+    args = parser.parse_args(argv)
+
+    topics = read_topics(args.topics)
+    if not topics:
+        parser.error("no topics given")
+
+    started = time.monotonic()
+    if args.kind == "movie":
+        results, stats = asyncio.run(run_movies(topics, args))
+    else:
+        results, stats = run_images(topics, args)
+    elapsed = time.monotonic() - started
+
+    done = sum(result["status"] == "done" for result in results)
+    summary = {
+        "kind": args.kind,
+        "topics": len(topics),
+        "done": done,
+        "failed": len(topics) - done,
+        "wall_seconds": elapsed,
+        "per_hour": done * 3600 / elapsed if elapsed else None,
+        "results": results,
+        "stats": stats,
+        "stages": metrics.snapshot()["stages"],
+    }
+    with open(args.summary, "w") as f:
+        json.dump(summary, f, indent=4)
+    print(f"{done}/{len(topics)} done in {elapsed:.0f}s ({summary['per_hour'] or 0:.1f}/hour), summary in {args.summary}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Stand-in for the AUTOMATIC1111 Stable Diffusion API.
+
+Serves /sdapi/v1/txt2img and /sdapi/v1/img2img with freshly generated noise
+PNGs after a configurable delay, and fails a configurable share of requests
+with 503. It also answers /v1/chat/completions like the frame reviewer in
+gpt_review.py expects, approving frames scored 0.5 or more, so the gpt3.5
+director can point its openai_api_base here. Run it on its own or let
+run_benchmarks.py start it:
+
+    python benchmarks/fake_sd.py --port 7861 --latency 0.5 --failure-rate 0.05
+"""
+import argparse
+import base64
+import io
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+
+def noise_png(width, height):
+    bands = [Image.effect_noise((width, height), 64) for _ in range(3)]
+    buffer = io.BytesIO()
+    Image.merge("RGB", bands).save(buffer, format="PNG", compress_level=1)
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+class FakeSDServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.5, jitter=0.0, failure_rate=0.0, image_size=None, seed=0):
+        super().__init__(address, FakeSDHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.image_size = image_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+
+    def roll(self):
+        with self.lock:
+            self.requests += 1
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            failed = self.random.random() < self.failure_rate
+            if failed:
+                self.failures += 1
+        return delay, failed
+
+
+class FakeSDHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def chat_completion(self, payload):
+        frames = json.loads(payload["messages"][-1]["content"])
+        verdicts = [{"id": frame["id"], "decision": "approve" if frame["aesthetic_score"] >= 0.5 else "reject"} for frame in frames]
+        return {
+            "object": "chat.completion",
+            "model": payload.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": json.dumps(verdicts)}, "finish_reason": "stop"}],
+        }
+
+    def do_POST(self):
+        if self.path == "/v1/chat/completions":
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            delay, failed = self.server.roll()
+            time.sleep(delay)
+            if failed:
+                self._reply(503, {"error": {"message": "Injected failure"}})
+            else:
+                self._reply(200, self.chat_completion(payload))
+            return
+        if self.path not in ("/sdapi/v1/txt2img", "/sdapi/v1/img2img"):
+            self._reply(404, {"detail": "Not Found"})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+
+        delay, failed = self.server.roll()
+        started = time.monotonic()
+        if failed:
+            time.sleep(delay)
+            self._reply(503, {"detail": "Injected failure"})
+            return
+
+        width, height = self.server.image_size or (int(payload.get("width", 512)), int(payload.get("height", 512)))
+        count = int(payload.get("batch_size", 1)) * int(payload.get("n_iter", 1))
+        images = [noise_png(width, height) for _ in range(count)]
+        # The delay covers the time spent making the images
+        time.sleep(max(0.0, delay - (time.monotonic() - started)))
+        self._reply(200, {"images": images, "parameters": payload, "info": "{}"})
+
+
+def parse_size(size):
+    if not size:
+        return None
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0, help="0 picks a free port")
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds per request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="+/- seconds added to the latency")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--image-size", default=None, help="WxH; defaults to the payload's width and height")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    server = FakeSDServer((args.host, args.port), latency=args.latency, jitter=args.jitter,
+                          failure_rate=args.failure_rate, image_size=parse_size(args.image_size), seed=args.seed)
+    # run_benchmarks.py reads the URL from the first line
+    print(f"http://{args.host}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"{server.requests} requests, {server.failures} failed", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""Measure end-to-end throughput against local SD and Llama stand-ins.
+
+Starts benchmarks/fake_sd.py, then runs each scenario in its own process with
+the stub Llama and aesthetic models installed, and writes one JSON report with
+frames/sec, p50/p99 latency per stage and peak RSS per scenario. For mode_goat,
+frames counts every frame of the movie and keyframes the ones SD rendered:
+
+    python benchmarks/run_benchmarks.py --output bench.json
+    python benchmarks/run_benchmarks.py --scenarios cafe --sd-latency 0.2 --sd-failure-rate 0.1
+
+Scenarios:
+    mode_goat  mode-goat.py make_movie (the /generate_movie route), 50 frames
+    test19     test19.py start_movie, 500 frames of text
+    cafe       Cafe script interpolate_images: two best-of-N searches and a crossfade
+
+Compare reports from two commits to catch regressions; keep the settings equal.
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SCENARIOS = ["mode_goat", "test19", "cafe"]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def load_script(filename, name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench_mode_goat(config, timings):
+    module = load_script("mode-goat.py", "mode_goat")
+    last = [time.perf_counter()]
+
+    def progress(frames_done=None, **fields):
+        if frames_done:
+            now = time.perf_counter()
+            timings.record("frame", now - last[0])
+            last[0] = now
+
+    try:
+        asyncio.run(module.make_movie("benchmark", pipeline_depth=config["pipeline_depth"], resume=False, progress=progress,
+                                      keyframe_every=config["keyframe_every"], tween=config["tween"]))
+    finally:
+        module.inference.close()
+    with open(os.path.join("movies", "benchmark", "manifest.json")) as f:
+        manifest = json.load(f)
+    # Every frame of the movie counts, tweened ones included; keyframes are what Llama and SD rendered
+    return {
+        "frames": module.metrics.snapshot()["counters"].get("video_frames", 0),
+        "keyframes": sum(1 for frame in manifest["frames"].values() if frame["status"] == module.RENDERED),
+    }
+
+
+def bench_test19(config, timings):
+    module = load_script("test19.py", "test19")
+    try:
+        result = asyncio.run(module.start_movie("benchmark", resume=False))
+    finally:
+        module.inference.close()
+    if not os.path.exists("benchmark_movie_frames.json"):
+        raise RuntimeError(result["message"])
+    with open("benchmark_movie_frames.json") as f:
+        return len(json.load(f))
+
+
+def bench_cafe(config, timings):
+    module = load_script("Cafe.Aesthetic.Stable.Diffusion.Interpolation.Video.py", "cafe")
+    # The generator keeps its database next to the script; keep it in the work dir instead
+    module.__file__ = os.path.join(os.getcwd(), "cafe.py")
+    generator = module.AdvancedImageGenerator()
+    generator.generate_best_aesthetic_image = timings.timed("best_of_n", generator.generate_best_aesthetic_image)
+    try:
+        generator.interpolate_images("A beautiful sunset", "A beautiful sunrise", "interpolation", num_frames=config["interpolation_frames"])
+    finally:
+        generator.close()
+    if not os.path.isdir("interpolation"):
+        raise RuntimeError("No best image reached the aesthetic threshold")
+    return len(os.listdir("interpolation"))
+
+
+def run_child(name, config, result_path):
+    sys.path.insert(0, REPO_DIR)
+    sys.path.insert(0, BENCH_DIR)
+    from standins import Timings, install_stub_aesthetic, install_stub_llama, time_sd_requests
+
+    timings = Timings()
+    install_stub_llama(timings, tokens_per_second=config["llama_tps"], completion_tokens=config["llama_tokens"],
+                       prompt_tokens_per_second=config["llama_prompt_tps"])
+    install_stub_aesthetic(timings, seconds_per_image=config["aesthetic_latency"])
+    time_sd_requests(timings)
+
+    report = {"frames": 0, "error": None}
+    started = time.perf_counter()
+    try:
+        result = globals()[f"bench_{name}"](config, timings)
+        report.update(result if isinstance(result, dict) else {"frames": result})
+    except Exception as e:
+        report["error"] = f"{type(e).__name__}: {e}"
+    wall = time.perf_counter() - started
+    report.update({
+        "wall_seconds": wall,
+        "frames_per_second": report["frames"] / wall if wall else None,
+        "stages": timings.summary(),
+        "peak_rss_mb": peak_rss_mb(),
+    })
+    with open(result_path, "w") as f:
+        json.dump(report, f)
+
+
+def start_fake_sd(config):
+    command = [sys.executable, os.path.join(BENCH_DIR, "fake_sd.py"), "--latency", str(config["sd_latency"]),
+               "--jitter", str(config["sd_jitter"]), "--failure-rate", str(config["sd_failure_rate"])]
+    if config["image_size"]:
+        command += ["--image-size", config["image_size"]]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    url = server.stdout.readline().strip()
+    if not url:
+        server.kill()
+        raise RuntimeError("fake SD server failed to start")
+    return server, url
+
+
+def run_scenario(name, config, sd_url, verbose=False):
+    with tempfile.TemporaryDirectory(prefix=f"bench-{name}-") as work_dir:
+        result_path = os.path.join(work_dir, "result.json")
+        # A fresh render cache per run, so every scenario really renders
+        env = dict(os.environ, SD_BACKENDS=sd_url, PRELOAD_MODELS="0", PYTHONUNBUFFERED="1",
+                   RENDER_CACHE_PATH=os.path.join(work_dir, "render_cache.sqlite"))
+        command = [sys.executable, os.path.abspath(__file__), "--child", name, "--config", json.dumps(config), "--result", result_path]
+        output = None if verbose else subprocess.DEVNULL
+        returncode = subprocess.run(command, cwd=work_dir, env=env, stdout=output, stderr=output).returncode
+        if not os.path.exists(result_path):
+            return {"error": f"scenario process exited with {returncode}"}
+        with open(result_path) as f:
+            return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated subset of " + ", ".join(SCENARIOS))
+    parser.add_argument("--output", help="write the JSON report here as well as to stdout")
+    parser.add_argument("--sd-latency", type=float, default=0.5)
+    parser.add_argument("--sd-jitter", type=float, default=0.1)
+    parser.add_argument("--sd-failure-rate", type=float, default=0.0)
+    parser.add_argument("--image-size", default=None, help="WxH; defaults to the size each request asks for")
+    parser.add_argument("--llama-tps", type=float, default=200.0, help="stub Llama completion tokens per second")
+    parser.add_argument("--llama-prompt-tps", type=float, default=500.0, help="stub Llama prompt tokens per second")
+    parser.add_argument("--llama-tokens", type=int, default=40, help="tokens per stub completion")
+    parser.add_argument("--aesthetic-latency", type=float, default=0.02, help="stub scorer seconds per image")
+    parser.add_argument("--interpolation-frames", type=int, default=50)
+    parser.add_argument("--pipeline-depth", type=int, default=2)
+    parser.add_argument("--keyframe-every", type=int, default=1, help="mode_goat: render every Kth frame with SD")
+    parser.add_argument("--tween", default="linear", help="mode_goat: how frames between keyframes are filled")
+    parser.add_argument("--verbose", action="store_true", help="show the scenarios' own output")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--config", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        run_child(args.child, json.loads(args.config), args.result)
+        return
+
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    config = {
+        "sd_latency": args.sd_latency,
+        "sd_jitter": args.sd_jitter,
+        "sd_failure_rate": args.sd_failure_rate,
+        "image_size": args.image_size,
+        "llama_tps": args.llama_tps,
+        "llama_prompt_tps": args.llama_prompt_tps,
+        "llama_tokens": args.llama_tokens,
+        "aesthetic_latency": args.aesthetic_latency,
+        "interpolation_frames": args.interpolation_frames,
+        "pipeline_depth": args.pipeline_depth,
+        "keyframe_every": args.keyframe_every,
+        "tween": args.tween,
+    }
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config,
+        "scenarios": {},
+    }
+
+    server, sd_url = start_fake_sd(config)
+    try:
+        for name in names:
+            print(f"Running {name}...", file=sys.stderr)
+            report["scenarios"][name] = run_scenario(name, config, sd_url, args.verbose)
+    finally:
+        server.terminate()
+        server.wait()
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""Model stand-ins and timing hooks for the benchmarks.
+
+`install_stub_llama` and `install_stub_aesthetic` register fake `llama_cpp` and
+`transformers` modules, so the scripts load these instead of multi-GB models.
+`time_sd_requests` times every request the SD client sends. All of them
+record into a shared `Timings`.
+"""
+import random
+import re
+import sys
+import threading
+import time
+import types
+
+
+class Timings:
+    def __init__(self):
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def timed(self, stage, fn):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - started)
+        return wrapper
+
+    def summary(self):
+        with self._lock:
+            samples = {stage: sorted(values) for stage, values in self.samples.items()}
+        return {
+            stage: {
+                "count": len(values),
+                "mean": sum(values) / len(values),
+                "p50": percentile(values, 50),
+                "p99": percentile(values, 99),
+                "max": values[-1],
+            }
+            for stage, values in samples.items()
+        }
+
+
+# Nearest-rank percentile of sorted values
+def percentile(values, pct):
+    rank = max(1, -(-len(values) * pct // 100))
+    return values[int(rank) - 1]
+
+
+WORDS = "the ship drifts past a silent moon while the crew watches stars fold into light".split()
+
+
+class StubState:
+    def __init__(self, input_ids, size):
+        self.input_ids = input_ids
+        self.llama_state_size = size
+
+
+class StubLlama:
+    """Stand-in for `llama_cpp.Llama` with a configurable speed.
+
+    Prompt tokens cost 1/`prompt_tokens_per_second` each. Like `Llama.generate`,
+    a prompt only pays for the tokens past its longest common prefix with the
+    context left by the previous call (prompt plus completion) or by
+    `eval`/`load_state`, so prefix reuse costs here what it costs on the real
+    model. Completions are `completion_tokens` words produced at
+    `tokens_per_second`. One token is one word with its leading whitespace.
+    """
+
+    tokens_per_second = 50.0
+    prompt_tokens_per_second = 500.0
+    completion_tokens = 40
+    state_bytes = 1024 * 1024
+
+    _vocab = {}
+    _words = ["", "<s>", "</s>"]
+    _vocab_lock = threading.Lock()
+
+    def __init__(self, model_path=None, n_ctx=512, seed=0, **kwargs):
+        self._n_ctx = n_ctx
+        self.input_ids = []
+        self._random = random.Random(seed)
+        self.timings = None
+
+    @property
+    def n_tokens(self):
+        return len(self.input_ids)
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def tokenize(self, text, add_bos=True):
+        tokens = [1] if add_bos else []
+        with self._vocab_lock:
+            for piece in re.findall(r"\s*\S+|\s+$", text.decode("utf-8", errors="ignore")):
+                if piece not in self._vocab:
+                    self._vocab[piece] = len(self._words)
+                    self._words.append(piece)
+                tokens.append(self._vocab[piece])
+        return tokens
+
+    def detokenize(self, tokens):
+        return "".join(self._words[token] for token in tokens if token > 2).encode("utf-8")
+
+    def reset(self):
+        self.input_ids = []
+
+    def eval(self, tokens):
+        time.sleep(len(tokens) / self.prompt_tokens_per_second)
+        self.input_ids.extend(tokens)
+
+    def save_state(self):
+        return StubState(list(self.input_ids), self.state_bytes)
+
+    def load_state(self, state):
+        self.input_ids = list(state.input_ids)
+
+    def _pieces(self, prompt, max_tokens):
+        tokens = self.tokenize(prompt.encode("utf-8"))
+        common = 0
+        for old, new in zip(self.input_ids, tokens):
+            if old != new:
+                break
+            common += 1
+        # llama_cpp always re-evaluates at least the last prompt token
+        common = min(common, len(tokens) - 1)
+        self.input_ids = self.input_ids[:common]
+        self.eval(tokens[common:])
+        for _ in range(min(max_tokens, self.completion_tokens)):
+            time.sleep(1 / self.tokens_per_second)
+            piece = " " + self._random.choice(WORDS)
+            self.input_ids.extend(self.tokenize(piece.encode("utf-8"), add_bos=False))
+            yield piece
+
+    def _generate(self, prompt, max_tokens=16, stop=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            for piece in self._pieces(prompt, max_tokens):
+                yield {"choices": [{"text": piece, "finish_reason": None}]}
+            yield {"choices": [{"text": "", "finish_reason": "length"}]}
+        finally:
+            if self.timings is not None:
+                self.timings.record("llama", time.perf_counter() - started)
+
+    def __call__(self, prompt, max_tokens=16, stop=None, stream=False, **kwargs):
+        chunks = self._generate(prompt, max_tokens, stop)
+        if stream:
+            return chunks
+        text = "".join(chunk["choices"][0]["text"] for chunk in chunks)
+        return {"choices": [{"text": text, "finish_reason": "length"}]}
+
+
+def install_stub_llama(timings, tokens_per_second=50.0, completion_tokens=40, prompt_tokens_per_second=500.0):
+    class ConfiguredLlama(StubLlama):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.timings = timings
+
+    ConfiguredLlama.tokens_per_second = tokens_per_second
+    ConfiguredLlama.completion_tokens = completion_tokens
+    ConfiguredLlama.prompt_tokens_per_second = prompt_tokens_per_second
+
+    module = types.ModuleType("llama_cpp")
+    module.Llama = ConfiguredLlama
+    sys.modules["llama_cpp"] = module
+
+
+# Fake transformers pipeline: `seconds_per_image` per image, scores uniform in [low, high)
+def install_stub_aesthetic(timings, seconds_per_image=0.02, low=0.5, high=1.0, seed=0):
+    rng = random.Random(seed)
+
+    def pipeline(task, model=None, **kwargs):
+        def classify(inputs, batch_size=1, **kwargs):
+            single = not isinstance(inputs, list)
+            inputs = [inputs] if single else inputs
+            started = time.perf_counter()
+            time.sleep(seconds_per_image * len(inputs))
+            results = [[{"label": "aesthetic", "score": rng.uniform(low, high)}] for _ in inputs]
+            timings.record("aesthetic", time.perf_counter() - started)
+            return results[0] if single else results
+        return classify
+
+    module = types.ModuleType("transformers")
+    module.pipeline = pipeline
+    sys.modules["transformers"] = module
+
+
+# Time every SD request made through SDClient, including those sent by SDScheduler
+def time_sd_requests(timings):
+    import sd_client
+
+    post = sd_client.SDClient.post
+
+    def timed_post(self, endpoint, payload):
+        started = time.perf_counter()
+        try:
+            return post(self, endpoint, payload)
+        finally:
+            timings.record("sd_" + endpoint.rsplit("/", 1)[-1], time.perf_counter() - started)
+
+    sd_client.SDClient.post = timed_post
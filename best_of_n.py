@@ -0,0 +1,68 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from sd_client import SDError
+
+
+class BestOfNSampler:
+    """Render candidates until one is good enough or the budget is spent.
+
+    `render()` performs one SD render and returns a list of images. `score(images)`
+    returns `(candidate, score)` pairs for them, where `candidate` is whatever the
+    caller wants back (an image, a filename, ...). Up to `concurrency` renders are
+    in flight at once; as soon as a candidate reaches `target_score` or `budget`
+    renders have been issued, renders not yet started are cancelled and running
+    ones are abandoned.
+    """
+
+    def __init__(self, render, score, target_score=0.9, budget=25, concurrency=4):
+        self.render = render
+        self.score = score
+        self.target_score = target_score
+        self.budget = budget
+        self.concurrency = concurrency
+
+    def sample(self):
+        best_candidate = None
+        best_score = None
+        issued = 0
+        completed = 0
+        failed = 0
+        pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="best-of-n")
+        in_flight = set()
+        try:
+            while True:
+                reached = best_score is not None and best_score >= self.target_score
+                while not reached and issued < self.budget and len(in_flight) < self.concurrency:
+                    in_flight.add(pool.submit(self.render))
+                    issued += 1
+                if reached or not in_flight:
+                    break
+
+                # Score everything that finished since the last round as one batch
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                images = []
+                for future in done:
+                    try:
+                        images += future.result()
+                        completed += 1
+                    except SDError as e:
+                        logging.error(f"Error generating image: {e}")
+                        failed += 1
+                for candidate, score in self.score(images):
+                    if best_score is None or score > best_score:
+                        best_candidate, best_score = candidate, score
+        finally:
+            cancelled = sum(future.cancel() for future in in_flight)
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        stats = {
+            "budget": self.budget,
+            "renders_issued": issued - cancelled,
+            "renders_completed": completed,
+            "renders_failed": failed,
+            "renders_abandoned": len(in_flight) - cancelled,
+            "renders_saved": self.budget - issued + cancelled,
+            "target_reached": best_score is not None and best_score >= self.target_score,
+        }
+        return best_candidate, best_score, stats
@@ -0,0 +1,88 @@
+import json
+import os
+
+
+def read_frames(path):
+    """Yield (frame_key, text) pairs from a frame log, oldest first.
+
+    Works on a log that is still being written: a final line cut short by a
+    crash or an in-progress write is ignored.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                return
+            try:
+                record = json.loads(line)
+            except ValueError:
+                return
+            yield record["frame"], record["text"]
+
+
+# Write the frames in the log out as the final `{frame_key: text}` JSON document
+def compact(log_path, json_path):
+    frames = dict(read_frames(log_path))
+    tmp_path = json_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(frames, f, indent=4)
+    os.replace(tmp_path, json_path)
+    return frames
+
+
+class FrameLog:
+    """Append-only JSONL log of generated frames.
+
+    Each frame costs one short appended line instead of rewriting every frame so
+    far. Lines are flushed immediately and fsynced every `fsync_every` frames.
+    Opening a log drops a partial last line left by a crash, so appends always
+    start on a clean line.
+    """
+
+    def __init__(self, path, fsync_every=10):
+        self.path = path
+        self.fsync_every = fsync_every
+        self._unsynced = 0
+        self._truncate_partial_tail()
+        self.f = open(path, "a", encoding="utf-8")
+
+    def _truncate_partial_tail(self):
+        if not os.path.exists(self.path):
+            return
+        valid = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    json.loads(line)
+                except ValueError:
+                    break
+                valid += len(line)
+        if valid != os.path.getsize(self.path):
+            with open(self.path, "r+b") as f:
+                f.truncate(valid)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def append(self, frame_key, text):
+        self.f.write(json.dumps({"frame": frame_key, "text": text}) + "\n")
+        self.f.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        if not self.f.closed:
+            self.sync()
+            self.f.close()
@@ -0,0 +1,42 @@
+import asyncio
+
+
+# Run a two stage producer/consumer pipeline over frame indexes.
+#
+# `produce(index)` is awaited for every index in order and its result is put on a
+# bounded queue of size `depth`, so the producer can run at most `depth` frames
+# ahead of the consumers. `consume(index, item)` is awaited by `workers` consumer
+# tasks. Consumers may finish out of order; results are returned in index order.
+async def run_pipeline(num_items, produce, consume, depth=2, workers=1):
+    depth = max(1, depth)
+    workers = max(1, workers)
+    queue = asyncio.Queue(maxsize=depth)
+    results = [None] * num_items
+
+    async def producer():
+        for index in range(num_items):
+            item = await produce(index)
+            await queue.put((index, item))
+        for _ in range(workers):
+            await queue.put(None)
+
+    async def consumer():
+        while True:
+            entry = await queue.get()
+            if entry is None:
+                return
+            index, item = entry
+            results[index] = await consume(index, item)
+
+    tasks = [asyncio.ensure_future(producer())]
+    tasks += [asyncio.ensure_future(consumer()) for _ in range(workers)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # If one stage failed, don't leave the other blocked on the queue
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    return results
@@ -1,15 +1,15 @@
 import json
-import requests
 import random
 import sys
-import sqlite3
-from PIL import Image
-import io
 import os
-import base64
 from transformers import pipeline
 from moviepy.editor import ImageSequenceClip
 import openai
+from image_store import ImageRepository
+from sd_client import SDClient, SDError
+from sd_images import decode_image
+
+sd_client = SDClient()
 
 # Read API key from config.json
 with open("config.json", "r") as f:
@@ -27,15 +27,10 @@ class AestheticEvaluator:
 class AdvancedImageGenerator:
     def __init__(self):
         self.aesthetic_evaluator = AestheticEvaluator()
-        self.conn = sqlite3.connect('image_db.sqlite')
-        self.c = self.conn.cursor()
-        self.c.execute('''CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY AUTOINCREMENT, prompt TEXT, filename TEXT, aesthetic_score REAL, clip_features TEXT, last_words TEXT)''')
-        self.c.execute('''CREATE TABLE IF NOT EXISTS storyboards (id INTEGER PRIMARY KEY AUTOINCREMENT, prompt TEXT, storyboard TEXT)''')
-        self.conn.commit()
+        self.store = ImageRepository('image_db.sqlite')
 
     def close(self):
-        if self.conn:
-            self.conn.close()
+        self.store.close()
 
     def generate_images(self, message, duration):
         payload = {
@@ -45,23 +40,23 @@ class AdvancedImageGenerator:
             "width": 333,
             "height": 411,
         }
-        response = requests.post('http://127.0.0.1:7860/sdapi/v1/txt2img', json=payload)
-        if response.status_code == 200:
-            r = response.json()
-            for i, img_data in enumerate(r['images']):
-                image = Image.open(io.BytesIO(base64.b64decode(img_data.split(",", 1)[0])))
-                filename = f"{message}_{i}.png"
-                image.save(filename)
-                
-                aesthetic_score = self.aesthetic_evaluator.evaluate_aesthetic(filename)
-                self.c.execute("INSERT INTO images VALUES (?, ?, ?)", (message, filename, aesthetic_score))
-                self.conn.commit()
-                
-                if aesthetic_score > 0.7:
-                    print(f"High aesthetic score: {filename}, Score: {aesthetic_score}")
-                    return filename
-        else:
-            print("Error generating image: ", response.status_code)
+        try:
+            r = sd_client.txt2img(payload)
+        except SDError as e:
+            print("Error generating image: ", e)
+            return None
+        for i, img_data in enumerate(r['images']):
+            image = decode_image(img_data)
+            filename = f"{message}_{i}.png"
+            image.save(filename)
+            
+            # Score the decoded image rather than reading the PNG back
+            aesthetic_score = self.aesthetic_evaluator.evaluate_aesthetic(image.image)
+            self.store.add_image(message, filename, aesthetic_score)
+            
+            if aesthetic_score > 0.7:
+                print(f"High aesthetic score: {filename}, Score: {aesthetic_score}")
+                return filename
 
     def generate_video(self, message, num_frames=30):
         frames = []
@@ -71,16 +66,15 @@ class AdvancedImageGenerator:
                 "steps": 9,
                 "seed": random.randrange(sys.maxsize),
             }
-            response = requests.post('http://127.0.0.1:7860/sdapi/v1/txt2img', json=payload)
-            if response.status_code == 200:
-                r = response.json()
-                img_data = r['images'][0]
-                image = Image.open(io.BytesIO(base64.b64decode(img_data.split(",", 1)[0])))
-                filename = f"{message}_{i}.png"
-                image.save(filename)
-                frames.append(filename)
-            else:
-                print("Error generating image: ", response.status_code)
+            try:
+                r = sd_client.txt2img(payload)
+            except SDError as e:
+                print("Error generating image: ", e)
+                continue
+            image = decode_image(r['images'][0])
+            filename = f"{message}_{i}.png"
+            image.save(filename)
+            frames.append(filename)
 
         # Create video from frames
         clip = ImageSequenceClip(frames, fps=24)
@@ -105,3 +99,4 @@ if __name__ == "__main__":
     duration = input("Enter the duration of the movie (e.g., 1s for 1 second, 1m for 1 minute, 1hr for 1 hour): ")
     best_image = generator.generate_images("A beautiful sunset", duration)
     print(f"The best image is {best_image}")
+    generator.close()
@@ -1,41 +1,40 @@
 import json
-import requests
 import random
 import sys
-import sqlite3
-from PIL import Image
-import io
 import os
-import base64
-from transformers import pipeline
-from moviepy.editor import ImageSequenceClip
 import openai
+from aesthetic import AestheticEvaluator, ScoreCache
+from gpt_review import GPTReviewer, ReviewCache
+from image_store import ImageRepository
+from metrics import metrics
+from sd_client import SDClient, SDError
+from sd_images import PNGWriter, decode_images
+from video_sink import FFmpegVideoSink, parse_duration
+
+sd_client = SDClient()
 
 # Read API key from config.json
 with open("config.json", "r") as f:
     config = json.load(f)
     openai.api_key = config["openai_api_key"]
-
-class AestheticEvaluator:
-    def __init__(self):
-        self.pipe = pipeline("image-classification", model="cafeai/cafe_aesthetic")
-
-    def evaluate_aesthetic(self, image_path):
-        result = self.pipe(image_path)
-        return result[0]['score']
+    # Any OpenAI-compatible endpoint, e.g. a local stand-in, can do the reviews
+    review_api_base = config.get("openai_api_base") or os.environ.get("OPENAI_API_BASE")
 
 class AdvancedImageGenerator:
     def __init__(self):
-        self.aesthetic_evaluator = AestheticEvaluator()
-        self.conn = sqlite3.connect('image_db.sqlite')
-        self.c = self.conn.cursor()
-        self.c.execute('''CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY AUTOINCREMENT, prompt TEXT, filename TEXT, aesthetic_score REAL, clip_features TEXT, last_words TEXT)''')
-        self.c.execute('''CREATE TABLE IF NOT EXISTS storyboards (id INTEGER PRIMARY KEY AUTOINCREMENT, prompt TEXT, storyboard TEXT)''')
-        self.conn.commit()
+        self.store = ImageRepository('image_db.sqlite')
+        self.score_cache = ScoreCache('image_db.sqlite')
+        self.aesthetic_evaluator = AestheticEvaluator(cache=self.score_cache)
+        self.review_cache = ReviewCache('image_db.sqlite')
+        self.reviewer = GPTReviewer(cache=self.review_cache, api_base=review_api_base)
 
     def close(self):
-        if self.conn:
-            self.conn.close()
+        self.reviewer.close()
+        print(f"GPT reviews: {self.reviewer.stats()}")
+        print(f"Stage timings: {metrics.snapshot()['stages']}")
+        self.review_cache.close()
+        self.score_cache.close()
+        self.store.close()
 
     def generate_images(self, message, duration):
         payload = {
@@ -45,23 +44,22 @@ class AdvancedImageGenerator:
             "width": 333,
             "height": 411,
         }
-        response = requests.post('http://127.0.0.1:7860/sdapi/v1/txt2img', json=payload)
-        
-        if response.status_code != 200:
-            print("Error generating image: ", response.status_code)
+        try:
+            r = sd_client.txt2img(payload)
+        except SDError as e:
+            print("Error generating image: ", e)
             return None
 
-        r = response.json()
         best_image = None
 
-        for i, img_data in enumerate(r['images']):
-            image = Image.open(io.BytesIO(base64.b64decode(img_data.split(",", 1)[0])))
+        images = decode_images(r)
+        scores = self.aesthetic_evaluator.evaluate_batch([image.image for image in images])
+
+        for i, (image, aesthetic_score) in enumerate(zip(images, scores)):
             filename = f"{message}_{i}.png"
             image.save(filename)
             
-            aesthetic_score = self.aesthetic_evaluator.evaluate_aesthetic(filename)
-            self.c.execute("INSERT INTO images VALUES (?, ?, ?)", (message, filename, aesthetic_score))
-            self.conn.commit()
+            self.store.add_image(message, filename, aesthetic_score)
             
             if aesthetic_score > 0.7 and best_image is None:
                 print(f"High aesthetic score: {filename}, Score: {aesthetic_score}")
@@ -69,8 +67,7 @@ class AdvancedImageGenerator:
 
         return best_image
 
-    def generate_movie(self, message, num_frames=30, duration="30s"):
-        frames = []
+    def generate_movie(self, message, num_frames=30, duration="30s", save_every=1):
         frame_folder = "frames"
 
         # Create the folder if it doesn't exist
@@ -82,49 +79,39 @@ class AdvancedImageGenerator:
             print("No high aesthetic score image found.")
             return
 
-        for i in range(num_frames):
-            payload = {
-                "prompt": message,
-                "steps": 9,
-                "seed": random.randrange(sys.maxsize),
-                "width": 333,
-                "height": 411,
-            }
-            response = requests.post('http://127.0.0.1:7860/sdapi/v1/txt2img', json=payload)
-            
-            if response.status_code != 200:
-                print("Error generating image: ", response.status_code)
-                continue
-
-            r = response.json()
-
-            for img_data in r['images']:
-                image = Image.open(io.BytesIO(base64.b64decode(img_data.split(",", 1)[0])))
-                filename = f"{message}_{i}.png"
-                filepath = os.path.join(frame_folder, filename)
-                image.save(filepath)
-                frames.append(filepath)
-
-        clip = ImageSequenceClip(frames, fps=24)
+        # Stretch the frames over the requested duration and encode them as they arrive;
+        # every save_every-th frame is also kept as a PNG (0 = none)
         video_filename = f"{message}.mp4"
-        clip = clip.set_duration(duration)
-        clip.write_videofile(video_filename, codec="libx264")
+        fps = num_frames / parse_duration(duration)
+        png_pattern = os.path.join(frame_folder, f"{message}_{{}}.png")
+        with PNGWriter() as png_writer, FFmpegVideoSink(video_filename, fps=fps, codec="libx264", png_pattern=png_pattern,
+                                                        png_every=save_every, png_writer=png_writer) as sink:
+            for i in range(num_frames):
+                payload = {
+                    "prompt": message,
+                    "steps": 9,
+                    "seed": random.randrange(sys.maxsize),
+                    "width": 333,
+                    "height": 411,
+                }
+                try:
+                    r = sd_client.txt2img(payload)
+                except SDError as e:
+                    print("Error generating image: ", e)
+                    continue
+
+                for image in decode_images(r):
+                    sink.write(image)
 
         return video_filename
 
+    # "approve" or "reject". Reviews from concurrent callers share one request;
+    # use submit_review to keep rendering while the verdict is on its way.
     def review_with_gpt(self, aesthetic_score, clip_features):
-        context = f"Review this image with an aesthetic score of {aesthetic_score} and CLIP features {clip_features}. Should I approve or reject it?"
-        messages = [
-            {"role": "system", "content": "You are a movie-making assistant."},
-            {"role": "assistant", "content": context}
-        ]
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo-16k",
-            messages=messages,
-            max_tokens=50
-        )
-        decision = response['choices'][0]['message']['content'].strip()
-        return decision
+        return self.reviewer.review(aesthetic_score, clip_features)
+
+    def submit_review(self, aesthetic_score, clip_features):
+        return self.reviewer.submit(aesthetic_score, clip_features)
 
 if __name__ == "__main__":
     generator = AdvancedImageGenerator()
@@ -132,3 +119,4 @@ if __name__ == "__main__":
     best_image = generator.generate_movie("A beautiful sunset_movie", num_frames=30, duration=duration)
     if best_image:
         print(f"The generated movie is {best_image}")
+    generator.close()
@@ -0,0 +1,236 @@
+import hashlib
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import openai
+
+from metrics import metrics
+from sqlite_lru import SQLiteLRU
+
+REVIEW_MODEL = "gpt-3.5-turbo-16k"
+APPROVE = "approve"
+REJECT = "reject"
+
+SYSTEM_PROMPT = (
+    "You are a movie-making assistant reviewing generated frames. The user sends a JSON array of frames, "
+    "each with an id, an aesthetic score between 0 and 1 and its CLIP features. Reply with only a JSON array "
+    'holding one object per frame, {"id": <id>, "decision": "approve"} or {"id": <id>, "decision": "reject"}.'
+)
+
+
+class ReviewError(RuntimeError):
+    pass
+
+
+# Round every number in the inputs, so near-identical frames share one review
+def rounded(value, digits):
+    if isinstance(value, float):
+        return round(value, digits)
+    if isinstance(value, dict):
+        return {str(key): rounded(item, digits) for key, item in sorted(value.items())}
+    if hasattr(value, "tolist"):  # numpy arrays and scalars
+        return rounded(value.tolist(), digits)
+    if isinstance(value, (list, tuple)):
+        return [rounded(item, digits) for item in value]
+    return value
+
+
+def review_key(aesthetic_score, clip_features, model):
+    text = json.dumps([model, aesthetic_score, clip_features], sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=20).hexdigest()
+
+
+# The reply should be a bare JSON array, but chat models like to wrap it in prose or a code fence
+def parse_verdicts(text):
+    start, end = text.find("["), text.rfind("]")
+    if start < 0 or end < start:
+        raise ReviewError(f"No JSON array in review reply: {text[:200]!r}")
+    try:
+        items = json.loads(text[start:end + 1])
+    except ValueError as e:
+        raise ReviewError(f"Bad JSON in review reply: {e}")
+    verdicts = {}
+    for item in items:
+        if isinstance(item, dict) and "id" in item:
+            decision = str(item.get("decision", "")).strip().lower()
+            verdicts[str(item["id"])] = APPROVE if decision.startswith(APPROVE) else REJECT
+    return verdicts
+
+
+class ReviewCache(SQLiteLRU):
+    """Review decisions keyed by a hash of the rounded inputs, in a `gpt_reviews` table."""
+
+    def __init__(self, db_path, max_entries=4096):
+        super().__init__(db_path, "gpt_reviews", ["review_key"], "decision", max_entries=max_entries)
+
+    def get(self, key):
+        return super().get((key,))
+
+    def put_many(self, entries):
+        super().put_many([((key,), decision) for key, decision in entries])
+
+
+class GPTReviewer:
+    """Approve or reject frames with a chat model, many frames per request.
+
+    `submit(score, features)` returns a future right away, so the caller can go
+    on rendering. Frames queued within `max_wait` seconds of each other are
+    sent together, up to `batch_size` per request and `concurrency` requests
+    at a time. Inputs are rounded to `digits` places; a decision already in
+    `cache` (or for the same inputs still in flight) is reused instead of
+    asked for again. `api_base` points the requests at another
+    OpenAI-compatible endpoint, such as a local stand-in.
+    """
+
+    def __init__(self, model=REVIEW_MODEL, cache=None, batch_size=16, max_wait=0.25, concurrency=2,
+                 digits=2, api_base=None, api_key=None):
+        self.model = model
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.digits = digits
+        self.api_base = api_base
+        self.api_key = api_key
+        self.requests = 0
+        self.reviewed = 0
+        self._queue = queue.Queue()
+        self._inflight = {}
+        self._closed = False
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="gpt-review")
+        self._collector = threading.Thread(target=self._collect, name="gpt-review-batcher", daemon=True)
+        self._collector.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # Reviews already submitted are still sent; submitting after this raises
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._collector.join()
+        self._executor.shutdown(wait=True)
+
+    def submit(self, aesthetic_score, clip_features):
+        if self._closed:
+            raise RuntimeError("GPTReviewer is closed")
+        score, features = rounded(float(aesthetic_score), self.digits), rounded(clip_features, self.digits)
+        key = review_key(score, features, self.model)
+        decision = self.cache.get(key) if self.cache is not None else None
+        if decision is not None:
+            metrics.inc("gpt_review_cache_hits")
+            future = Future()
+            future.set_result(decision)
+            return future
+        with self._lock:
+            # Checked again under the lock, so nothing is queued behind close()'s stop marker
+            if self._closed:
+                raise RuntimeError("GPTReviewer is closed")
+            future = self._inflight.get(key)
+            if future is not None:
+                return future
+            future = self._inflight[key] = Future()
+            self._queue.put((key, score, features, future))
+        return future
+
+    def review(self, aesthetic_score, clip_features):
+        return self.submit(aesthetic_score, clip_features).result()
+
+    # Decisions for many (score, features) pairs, in order
+    def review_many(self, items):
+        futures = [self.submit(score, features) for score, features in items]
+        return [future.result() for future in futures]
+
+    def _collect(self):
+        closing = False
+        while not closing:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+            self._executor.submit(self._review_batch, batch)
+
+    def _review_batch(self, batch):
+        try:
+            verdicts = self._request(batch)
+            missing = [i for i in range(len(batch)) if str(i) not in verdicts]
+            if missing:
+                raise ReviewError(f"Review reply skipped {len(missing)} of {len(batch)} frames")
+        except Exception as e:
+            logging.error(f"Error reviewing frames: {e}")
+            for key, _, _, future in batch:
+                self._finish(key, future, error=e)
+            return
+
+        if self.cache is not None:
+            try:
+                self.cache.put_many([(key, verdicts[str(i)]) for i, (key, _, _, _) in enumerate(batch)])
+            except sqlite3.Error as e:
+                logging.error(f"Error caching reviews: {e}")
+        for i, (key, _, _, future) in enumerate(batch):
+            self._finish(key, future, decision=verdicts[str(i)])
+
+    def _finish(self, key, future, decision=None, error=None):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(decision)
+
+    def _request(self, batch):
+        frames = [{"id": i, "aesthetic_score": score, "clip_features": features} for i, (_, score, features, _) in enumerate(batch)]
+        kwargs = {}
+        if self.api_base:
+            kwargs["api_base"] = self.api_base
+        if self.api_key:
+            kwargs["api_key"] = self.api_key
+        with metrics.timer("gpt_review", frames=len(batch)):
+            response = openai.ChatCompletion.create(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": json.dumps(frames, separators=(",", ":"))},
+                ],
+                max_tokens=64 + 32 * len(batch),
+                temperature=0,
+                **kwargs
+            )
+        with self._lock:
+            self.requests += 1
+            self.reviewed += len(batch)
+        metrics.inc("gpt_review_frames", len(batch))
+        return parse_verdicts(response["choices"][0]["message"]["content"])
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "requests": self.requests,
+                "reviewed": self.reviewed,
+                "frames_per_request": self.reviewed / self.requests if self.requests else 0.0,
+                "in_flight": len(self._inflight),
+            }
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
@@ -0,0 +1,96 @@
+import logging
+import sqlite3
+import threading
+
+from metrics import metrics
+
+IMAGE_COLUMNS = ["id", "prompt", "filename", "aesthetic_score", "clip_features", "last_words"]
+
+
+class ImageRepository:
+    """Shared access to image_db.sqlite.
+
+    Opens the database in WAL mode and queues inserts, committing them in one
+    transaction once `batch_size` rows are pending or `flush_interval` seconds
+    have passed. Safe to share between threads.
+    """
+
+    def __init__(self, db_path, batch_size=64, flush_interval=2.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self._lock = threading.RLock()
+        self._closed = threading.Event()
+
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+
+        self._flusher = threading.Thread(target=self._flush_periodically, name="image-store-flush", daemon=True)
+        self._flusher.start()
+
+    def _migrate(self):
+        with self._lock, self.conn:
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(images)")]
+            if columns and columns != IMAGE_COLUMNS:
+                # Older scripts created images(prompt, filename, aesthetic_score); move
+                # whatever columns we recognise into the current layout
+                logging.info(f"Migrating images table from {columns} to {IMAGE_COLUMNS}")
+                kept = [c for c in columns if c in IMAGE_COLUMNS and c != "id"]
+                self.conn.execute("ALTER TABLE images RENAME TO images_old")
+                self._create_images_table()
+                self.conn.execute(f"INSERT INTO images ({', '.join(kept)}) SELECT {', '.join(kept)} FROM images_old")
+                self.conn.execute("DROP TABLE images_old")
+            else:
+                self._create_images_table()
+            self.conn.execute('''CREATE INDEX IF NOT EXISTS images_filename ON images (filename)''')
+            self.conn.execute('''CREATE INDEX IF NOT EXISTS images_prompt ON images (prompt)''')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS storyboards (id INTEGER PRIMARY KEY AUTOINCREMENT, prompt TEXT, storyboard TEXT)''')
+
+    def _create_images_table(self):
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY AUTOINCREMENT, prompt TEXT, filename TEXT, aesthetic_score REAL, clip_features TEXT, last_words TEXT)''')
+
+    def add_image(self, prompt, filename, aesthetic_score, clip_features=None, last_words=None):
+        with self._lock:
+            self.pending.append((prompt, filename, aesthetic_score, clip_features, last_words))
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+
+    def add_storyboard(self, prompt, storyboard):
+        with self._lock, self.conn:
+            self.conn.execute("INSERT INTO storyboards (prompt, storyboard) VALUES (?, ?)", (prompt, storyboard))
+
+    def flush(self):
+        with self._lock:
+            if not self.pending:
+                return
+            rows, self.pending = self.pending, []
+            with metrics.timer("sqlite_image_flush"), self.conn:
+                self.conn.executemany("INSERT INTO images (prompt, filename, aesthetic_score, clip_features, last_words) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logging.error(f"Error flushing image rows: {e}")
+
+    def get_score(self, filename):
+        with self._lock:
+            for row in reversed(self.pending):
+                if row[1] == filename:
+                    return row[2]
+            row = self.conn.execute("SELECT aesthetic_score FROM images WHERE filename=? ORDER BY id DESC LIMIT 1", (filename,)).fetchone()
+            return row[0] if row else None
+
+    def images_for_prompt(self, prompt):
+        self.flush()
+        with self._lock:
+            return self.conn.execute("SELECT filename, aesthetic_score FROM images WHERE prompt=? ORDER BY id", (prompt,)).fetchall()
+
+    def close(self):
+        self._closed.set()
+        self._flusher.join()
+        self.flush()
+        self.conn.close()
@@ -0,0 +1,155 @@
+import asyncio
+import contextvars
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from metrics import metrics
+
+
+class ServiceOverloaded(RuntimeError):
+    pass
+
+
+class _Request:
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.future = Future()
+        self.enqueued = time.monotonic()
+        # Run in the submitter's context so its metrics trace sees the call
+        self.context = contextvars.copy_context()
+
+
+class _JobExecutor:
+    # Executor-shaped view of the service for one job, for loop.run_in_executor
+    def __init__(self, service, job):
+        self.service = service
+        self.job = job
+
+    def submit(self, fn, *args):
+        return self.service.submit(fn, *args, job=self.job)
+
+
+class InferenceService:
+    """Run model calls on a fixed set of model replicas.
+
+    Each replica (e.g. a `PrefixStateCache` around its own `Llama`) gets one
+    dedicated thread, so a replica never runs two calls at once. Requests are
+    queued per job and replicas take them round-robin across jobs, so a long
+    movie can't starve a new one. At most `max_queue` requests may wait; beyond
+    that `submit` raises `ServiceOverloaded`.
+
+    Submitted functions run on a replica thread and reach their replica through
+    `current_replica()`, or by calling the service itself or `stream`.
+    """
+
+    def __init__(self, replicas, max_queue=64):
+        self.replicas = list(replicas)
+        self.max_queue = max_queue
+        self._queues = OrderedDict()
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._closed = False
+
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.total_inference = 0.0
+        self.max_wait = 0.0
+
+        self._threads = [threading.Thread(target=self._serve, args=(replica,), name=f"llama-replica-{i}", daemon=True)
+                         for i, replica in enumerate(self.replicas)]
+        for thread in self._threads:
+            thread.start()
+
+    def current_replica(self):
+        replica = getattr(self._local, "replica", None)
+        if replica is None:
+            raise RuntimeError("Model calls must run through InferenceService.submit")
+        return replica
+
+    def __call__(self, prompt, **kwargs):
+        return self.current_replica()(prompt, **kwargs)
+
+    def stream(self, prompt, **kwargs):
+        return self.current_replica().stream(prompt, **kwargs)
+
+    def submit(self, fn, *args, job="default"):
+        request = _Request(fn, args)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("InferenceService is closed")
+            if self._queued >= self.max_queue:
+                self.rejected += 1
+                raise ServiceOverloaded(f"Inference queue is full ({self._queued} requests waiting)")
+            self._queues.setdefault(job, deque()).append(request)
+            self._queued += 1
+            self._cond.notify()
+        return request.future
+
+    async def run(self, fn, *args, job="default"):
+        return await asyncio.wrap_future(self.submit(fn, *args, job=job))
+
+    def executor(self, job="default"):
+        return _JobExecutor(self, job)
+
+    def _next_request(self):
+        with self._cond:
+            while not self._queues and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return None
+            # Take from the job at the front, then send that job to the back
+            job, queue = next(iter(self._queues.items()))
+            request = queue.popleft()
+            if queue:
+                self._queues.move_to_end(job)
+            else:
+                del self._queues[job]
+            self._queued -= 1
+            return request
+
+    def _serve(self, replica):
+        self._local.replica = replica
+        while True:
+            request = self._next_request()
+            if request is None:
+                return
+            if not request.future.set_running_or_notify_cancel():
+                continue
+            started = time.monotonic()
+            try:
+                result = request.context.run(request.fn, *request.args)
+            except BaseException as e:
+                request.future.set_exception(e)
+            else:
+                request.future.set_result(result)
+            finished = time.monotonic()
+            wait = started - request.enqueued
+            request.context.run(metrics.observe, "llama_queue_wait", wait)
+            with self._cond:
+                self.completed += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.total_inference += finished - started
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "replicas": len(self.replicas),
+                "queued": self._queued,
+                "queued_by_job": {job: len(queue) for job, queue in self._queues.items()},
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "avg_queue_wait": self.total_wait / self.completed if self.completed else None,
+                "max_queue_wait": self.max_wait,
+                "avg_inference_time": self.total_inference / self.completed if self.completed else None,
+            }
@@ -0,0 +1,106 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+JOB_FIELDS = ["id", "params", "status", "stage", "frames_done", "total_frames", "created", "started", "finished", "result", "error"]
+
+
+class JobQueue:
+    """Persistent queue of long running jobs executed by a bounded worker pool.
+
+    `run_job(params, progress, restarted)` is awaited for each job; it calls
+    `progress(stage=..., frames_done=..., total_frames=...)` as it goes and
+    returns a JSON-serialisable result. `restarted` is True when the job had
+    already started before a restart interrupted it. Jobs are stored in SQLite at `db_path`,
+    so queued jobs and jobs interrupted by a restart run again when the queue
+    starts. The database is only opened by `start()`.
+    """
+
+    def __init__(self, run_job, db_path="jobs.sqlite", max_concurrent=1):
+        self.run_job = run_job
+        self.db_path = db_path
+        self.max_concurrent = max_concurrent
+        self._lock = threading.Lock()
+        self._queue = None
+        self._workers = []
+        self.conn = None
+
+    def _open(self):
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, params TEXT, status TEXT, stage TEXT, frames_done INTEGER, total_frames INTEGER, created REAL, started REAL, finished REAL, result TEXT, error TEXT)''')
+        self.conn.commit()
+
+    async def start(self):
+        if self.conn is None:
+            self._open()
+        self._queue = asyncio.Queue()
+        with self._lock, self.conn:
+            pending = [row[0] for row in self.conn.execute("SELECT id FROM jobs WHERE status IN ('queued', 'running') ORDER BY created")]
+            self.conn.execute("UPDATE jobs SET status='queued', stage='queued' WHERE status='running'")
+        if pending:
+            logging.info(f"Re-queueing {len(pending)} unfinished jobs")
+        for job_id in pending:
+            self._queue.put_nowait(job_id)
+        self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.max_concurrent)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self.conn is not None:
+            with self._lock:
+                self.conn.close()
+                self.conn = None
+
+    def submit(self, params):
+        job_id = uuid.uuid4().hex
+        with self._lock, self.conn:
+            self.conn.execute("INSERT INTO jobs (id, params, status, stage, frames_done, created) VALUES (?, ?, 'queued', 'queued', 0, ?)",
+                              (job_id, json.dumps(params), time.time()))
+        self._queue.put_nowait(job_id)
+        return job_id
+
+    def get(self, job_id):
+        with self._lock:
+            row = self.conn.execute(f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE id=?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(JOB_FIELDS, row))
+        job["params"] = json.loads(job["params"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        job["eta_seconds"] = None
+        if job["status"] == "running" and job["frames_done"] and job["total_frames"]:
+            elapsed = time.time() - job["started"]
+            job["eta_seconds"] = elapsed / job["frames_done"] * (job["total_frames"] - job["frames_done"])
+        return job
+
+    def _update(self, job_id, **fields):
+        assignments = ", ".join(f"{name}=?" for name in fields)
+        with self._lock, self.conn:
+            self.conn.execute(f"UPDATE jobs SET {assignments} WHERE id=?", (*fields.values(), job_id))
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            job = self.get(job_id)
+            if job is None or job["status"] != "queued":
+                continue
+            self._update(job_id, status="running", stage="starting", started=time.time())
+
+            def progress(**fields):
+                self._update(job_id, **fields)
+
+            try:
+                result = await self.run_job(job["params"], progress, restarted=job["started"] is not None)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Job {job_id} failed: {e}")
+                self._update(job_id, status="failed", stage="failed", error=str(e), finished=time.time())
+            else:
+                self._update(job_id, status="done", stage="done", result=json.dumps(result), finished=time.time())
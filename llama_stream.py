@@ -0,0 +1,69 @@
+import asyncio
+import threading
+import time
+
+
+class CompletionStream:
+    """Async iterator over the text of a streamed llama_cpp completion.
+
+    `generate(prompt, **kwargs)` must return a llama_cpp `stream=True` iterator
+    (e.g. `PrefixStateCache.stream`). It is consumed on an executor thread and
+    each piece of text is handed to the event loop as soon as it is produced.
+    Generation stops on a stop sequence or end of text, after `max_tokens`,
+    once `max_words` words have been produced, at `deadline` (a
+    `time.monotonic()` value), or when the consumer stops iterating.
+    `finish_reason` and `text` hold the outcome afterwards.
+    """
+
+    def __init__(self, generate, prompt, max_tokens, max_words=None, stop=(), deadline=None, executor=None):
+        self.generate = generate
+        self.prompt = prompt
+        self.max_tokens = max_tokens
+        self.max_words = max_words
+        self.stop = list(stop)
+        self.deadline = deadline
+        self.executor = executor
+        self.text = ""
+        self.finish_reason = None
+        self._cancelled = threading.Event()
+
+    def _run(self, loop, queue):
+        stream = self.generate(self.prompt, max_tokens=self.max_tokens, stop=self.stop)
+        try:
+            for chunk in stream:
+                choice = chunk["choices"][0]
+                piece = choice.get("text", "")
+                if piece:
+                    self.text += piece
+                    loop.call_soon_threadsafe(queue.put_nowait, piece)
+                if choice.get("finish_reason"):
+                    self.finish_reason = choice["finish_reason"]
+                    break
+                if self.max_words and len(self.text.split()) >= self.max_words:
+                    self.finish_reason = "words"
+                    break
+                if self.deadline is not None and time.monotonic() >= self.deadline:
+                    self.finish_reason = "timeout"
+                    break
+                if self._cancelled.is_set():
+                    self.finish_reason = "cancelled"
+                    break
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    async def __aiter__(self):
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue()
+        worker = loop.run_in_executor(self.executor, self._run, loop, queue)
+        try:
+            while True:
+                piece = await queue.get()
+                if piece is None:
+                    break
+                yield piece
+            await worker  # surface errors from the generation thread
+        finally:
+            self._cancelled.set()
@@ -0,0 +1,140 @@
+import bisect
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_trace = contextvars.ContextVar("metrics_trace", default=None)
+
+
+class TraceWriter:
+    """JSONL file of every timing recorded while it is the active trace."""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.f = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def write(self, stage, seconds, fields):
+        line = json.dumps({"time": time.time(), "stage": stage, "seconds": seconds, **fields})
+        with self._lock:
+            self.f.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            self.f.close()
+
+
+class Metrics:
+    """Process-wide stage timers and event counters.
+
+    `timer(stage)` / `observe(stage, seconds)` add to a per-stage latency
+    histogram; `inc(name)` bumps a counter. Recording is a lock and a few
+    additions, cheap enough to leave on. Timings recorded inside a
+    `trace(path)` block, including work it hands to threads that copy the
+    context, are also appended to that trace file.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.started = time.time()
+        self._timers = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds, **fields):
+        with self._lock:
+            timer = self._timers.get(stage)
+            if timer is None:
+                timer = self._timers[stage] = {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0, "max": 0.0}
+            timer["count"] += 1
+            timer["sum"] += seconds
+            timer["max"] = max(timer["max"], seconds)
+            bucket = bisect.bisect_left(self.buckets, seconds)
+            if bucket < len(self.buckets):
+                timer["buckets"][bucket] += 1
+        trace = _trace.get()
+        if trace is not None:
+            trace.write(stage, seconds, fields)
+
+    def inc(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    @contextlib.contextmanager
+    def timer(self, stage, **fields):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started, **fields)
+
+    # Decorator form of `timer`
+    def timed(self, stage):
+        def decorate(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    # Send the timings recorded in this context to a JSONL file at `path`; no-op for None
+    @contextlib.contextmanager
+    def trace(self, path):
+        if path is None:
+            yield None
+            return
+        writer = TraceWriter(path)
+        token = _trace.set(writer)
+        try:
+            yield writer
+        finally:
+            _trace.reset(token)
+            writer.close()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "uptime_seconds": time.time() - self.started,
+                "stages": {
+                    stage: {
+                        "count": timer["count"],
+                        "total_seconds": timer["sum"],
+                        "mean_seconds": timer["sum"] / timer["count"],
+                        "max_seconds": timer["max"],
+                    }
+                    for stage, timer in self._timers.items()
+                },
+                "counters": dict(self._counters),
+            }
+
+    # Prometheus text exposition format
+    def prometheus(self, prefix="modegoat"):
+        with self._lock:
+            timers = {stage: dict(timer, buckets=list(timer["buckets"])) for stage, timer in self._timers.items()}
+            counters = dict(self._counters)
+
+        lines = [f"# TYPE {prefix}_stage_seconds histogram"]
+        for stage, timer in sorted(timers.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, timer["buckets"]):
+                cumulative += count
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {timer["count"]}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {timer["sum"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {timer["count"]}')
+        lines.append(f"# TYPE {prefix}_events_total counter")
+        for name, value in sorted(counters.items()):
+            lines.append(f'{prefix}_events_total{{event="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
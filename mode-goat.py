@@ -1,97 +1,142 @@
-from fastapi import FastAPI, Query
-from fastapi.responses import JSONResponse
-from moviepy.editor import ImageSequenceClip
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import JSONResponse, PlainTextResponse
+from pydantic import BaseModel, Field
 from PIL import Image
 import pytesseract
 import asyncio
 import random
-import requests
 import asyncio
 import sys
 import datetime
-import io
-import base64
 import os
 import logging
-from concurrent.futures import ThreadPoolExecutor
+import time
+from collections import defaultdict
 from threading import Lock
 import uvicorn
+from crossfade import tween_frames, tween_unavailable
+from frame_pipeline import run_pipeline
+from inference_service import InferenceService, ServiceOverloaded
+from job_queue import JobQueue
+from metrics import metrics
+from llama_stream import CompletionStream
+from model_loader import LazyModel, readiness
+from movie_manifest import PENDING, RENDERED, WRITTEN, MovieManifest
+from prefix_cache import PrefixStateCache
+from prompt_budget import PromptBudgeter
+from render_cache import RenderCache
+from sd_client import SDError
+from sd_images import PNGWriter, SDImage, decode_images
+from sd_scheduler import SDScheduler
+from video_sink import FFmpegVideoSink
 # Initialize logging
 logging.basicConfig(level=logging.DEBUG)
 
 # Initialize FastAPI
 app = FastAPI()
 
-# Initialize ThreadPoolExecutor
-executor = ThreadPoolExecutor(max_workers=1)
+# Initialize the Stable Diffusion client (pooled, non-blocking, spread over SD_BACKENDS)
+# Frames are rendered with fixed seeds, so responses are cached on disk: re-runs and
+# resumed movies cost no SD time for frames rendered before
+sd_client = RenderCache(
+    SDScheduler.from_env(),
+    db_path=os.environ.get("RENDER_CACHE_PATH", "render_cache.sqlite"),
+    max_bytes=int(os.environ.get("RENDER_CACHE_MAX_MB", 2048)) * 1024 * 1024,
+)
 
 # Initialize Lock for thread safety
 seed_pool_lock = Lock()
 
-# Initialize Llama2
-from llama_cpp import Llama
+# Llama2 model file
 script_dir = os.path.dirname(os.path.realpath(__file__))
 model_path = os.path.join(script_dir, "llama-2-7b.ggmlv3.q8_0.bin")
-llm = Llama(model_path=model_path, n_ctx=100)
 
 # Prompt Engineering
 context_info = "Generate a Story Frame By Frame with as Llama2Stable LLM2IMG"
 multiple_prompts = ["What happens next? this this frame"]
 seed_pool = [random.randint(0, 10000) for _ in range(10)]
 
-def check_token_count(text):
-    return len(text.split())
+# Frame text ends early when the model starts writing the next frame
+STOP_SEQUENCES = ["Frame Number:"]
 
-# Function to truncate or summarize text
-def truncate_or_summarize(text):
-    return " ".join(text.split()[:25])
+# How many frames of text Llama may write ahead of the frame SD is rendering
+PIPELINE_DEPTH = 2
+
+# How many movies the /jobs worker pool generates at the same time
+MAX_CONCURRENT_MOVIES = int(os.environ.get("MAX_CONCURRENT_MOVIES", 1))
+
+# Number of model copies serving Llama calls (each one holds the full model in memory)
+LLAMA_REPLICAS = int(os.environ.get("LLAMA_REPLICAS", 1))
+
+# How many Llama calls may wait for a replica before new ones are turned away
+LLAMA_MAX_QUEUE = int(os.environ.get("LLAMA_MAX_QUEUE", 16))
+
+# mmap the model file so uvicorn worker processes share one copy through the page cache;
+# LLAMA_USE_MLOCK=1 also pins it in RAM
+LLAMA_USE_MMAP = os.environ.get("LLAMA_USE_MMAP", "1") != "0"
+LLAMA_USE_MLOCK = os.environ.get("LLAMA_USE_MLOCK", "0") == "1"
+
+# Start loading the models in the background at startup; otherwise the first movie loads them
+PRELOAD_MODELS = os.environ.get("PRELOAD_MODELS", "1") != "0"
+
+
+def load_llama():
+    from llama_cpp import Llama
+    return Llama(model_path=model_path, n_ctx=100, use_mmap=LLAMA_USE_MMAP, use_mlock=LLAMA_USE_MLOCK)
 
-async def llama_generate_async(prompt, max_tokens=100):
-    try:
-        if len(prompt.split()) > 99:
-            prompt = " ".join(prompt.split()[99])
-        
-        if check_token_count(prompt) > max_tokens:
-            prompt = truncate_or_summarize(prompt)
-        
-        loop = asyncio.get_event_loop()
-        output = await loop.run_in_executor(None, lambda: llm(prompt, max_tokens=min(max_tokens, 200)))
-        
-        if output is not None:
-            generated_text = output.get('choices', [{}])[0].get('text', '')
-            print(f"Llama Generated Text: {generated_text}")  # This will print the generated text
-            return generated_text
-        else:
-            return None
-    except Exception as e:
-        if "too many tokens" in str(e):
-            logging.error("Text too long, truncating...")
-            return await llama_generate_async(truncate_or_summarize(prompt), max_tokens)
-        else:
-            logging.error(f"Error in llama_generate_async: {e}")
-            return None
-    
 
+# Models are loaded on first use (or at startup with PRELOAD_MODELS), never at import.
+# Every frame prompt starts with context_info, so each replica caches its evaluated state.
+# Llama is not thread safe: all calls go through the inference service, one at a time per replica.
+models = [LazyModel(load_llama, name=f"llama-{i}") for i in range(LLAMA_REPLICAS)]
+replicas = [PrefixStateCache(model, prefixes=[context_info]) for model in models]
+inference = InferenceService(replicas, max_queue=LLAMA_MAX_QUEUE)
 
-async def chunk_and_generate(prompt, max_tokens=50, max_length=72, frame_number=None):
+# Measures and trims prompts with each replica's own tokenizer; context_info is tokenized once
+budgeters = {replica: PromptBudgeter(model, prefixes=[context_info]) for replica, model in zip(replicas, models)}
+
+# Fit a prompt into the context window, leaving room for `max_tokens` of completion.
+# Runs on a replica thread, so the tokenizer is never used while that model generates.
+def fit_prompt(prompt, max_tokens):
+    budgeter = budgeters[inference.current_replica()]
+    n_ctx = budgeter.llm.n_ctx()
+    max_tokens = max(1, min(max_tokens, 200, n_ctx // 2))
+    return budgeter.fit(prompt, n_ctx - max_tokens), max_tokens
+
+
+def fitted_stream(prompt, max_tokens, **kwargs):
+    prompt, max_tokens = fit_prompt(prompt, max_tokens)
+    return inference.stream(prompt, max_tokens=max_tokens, **kwargs)
+
+
+# Stream the text for one frame. Tokens are generated in rounds of the same prompt
+# until `max_length` words, a stop sequence or end of text; `max_rounds` and
+# `timeout` bound the work when the model keeps returning short or empty output.
+# Requests are scheduled fairly between `job`s.
+async def chunk_and_generate(prompt, max_tokens=50, max_length=72, frame_number=None, stop=STOP_SEQUENCES, max_rounds=4, timeout=120, job="default"):
     generated_text = ""
-    word_count = 0
-    MAX_TOKEN_LIMIT = 50
+    deadline = time.monotonic() + timeout
 
-    while True:
-        remaining_tokens = MAX_TOKEN_LIMIT - len(prompt.split())
-        if remaining_tokens <= 0:
-            print("Error: Prompt too long, skipping this chunk.")
+    for _ in range(max_rounds):
+        remaining_words = max_length - len(generated_text.split())
+        stream = CompletionStream(fitted_stream, prompt, max_tokens, max_words=remaining_words, stop=stop, deadline=deadline,
+                                  executor=inference.executor(job))
+        try:
+            async for piece in stream:
+                generated_text += piece
+        except ServiceOverloaded:
+            raise
+        except ValueError as e:
+            print(f"Error: Prompt too long, skipping this chunk: {e}")
+            break
+        except Exception as e:
+            logging.error(f"Error in chunk_and_generate: {e}")
             break
+        print(f"Llama Generated Text: {stream.text}")  # This will print the generated text
 
-        effective_max_tokens = min(max_tokens, remaining_tokens)
-        segment_story = await llama_generate_async(prompt, effective_max_tokens)
-        
-        if segment_story is not None:
-            generated_text += segment_story
-            word_count += len(segment_story.split())
-            if word_count >= max_length:
-                break
+        # Only a completion cut off by max_tokens is worth another round
+        if stream.finish_reason != "length" or not stream.text.strip():
+            break
 
     return generated_text
 
@@ -99,7 +144,6 @@ async def chunk_and_generate(prompt, max_tokens=50, max_length=72, frame_number=
 async def generate_images(prompt: str, prev_seed: int):
     images = []
     seed = prev_seed if prev_seed else random.randrange(sys.maxsize)
-    url = 'http://127.0.0.1:7860/sdapi/v1/txt2img'
     payload = {
         "prompt": prompt,
         "steps": 3,
@@ -110,64 +154,288 @@ async def generate_images(prompt: str, prev_seed: int):
         "width": 390,
         "height": 219,
     }
-    response = requests.post(url, json=payload)
-    if response.status_code == 200:
-        try:
-            r = response.json()
-            for i in r['images']:
-                images.append(Image.open(io.BytesIO(base64.b64decode(i))))
-        except ValueError as e:
-            logging.error(f"Error processing image data: {e}")
-    else:
-        logging.error(f"Error generating image: {response.status_code}")
+    try:
+        r = await sd_client.atxt2img(payload)
+        images = decode_images(r)
+    except SDError as e:
+        logging.error(f"Error generating image: {e}")
+    except ValueError as e:
+        logging.error(f"Error processing image data: {e}")
     return images, seed
 
 
+# Frame numbers that get their own text and SD render: every `keyframe_every`-th
+# frame, plus the last one so the movie ends on a rendered image
+def keyframe_numbers(total_frames, keyframe_every=1):
+    return sorted(set(range(0, total_frames, keyframe_every)) | {total_frames - 1})
+
+
+# Topics name a folder under movies/, so each must be one plain path component
+def valid_topic(topic):
+    return bool(topic.strip()) and topic not in (".", "..") and len(topic) <= 200 and not any(c in topic for c in "/\\\0")
+
+
+# Generate one movie of `total_frames` frames. Llama and SD only run for the
+# keyframes; with keyframe_every > 1 the frames between them are filled locally
+# by `tween` (see crossfade.TWEENS). `progress(**fields)` is called with the
+# current stage and frame count as generation moves along. Every keyframe is
+# checkpointed in the movie's manifest, so with `resume` a movie interrupted
+# part way picks up where it stopped: written text is reused, saved keyframes
+# are not rendered again and the seed chain continues from the last rendered one.
+# A movie that was finished is always made again from scratch.
+async def _make_movie(topic, pipeline_depth=PIPELINE_DEPTH, save_every=1, resume=True, progress=None,
+                     total_frames=50, keyframe_every=1, tween="linear"):
+    if not valid_topic(topic):
+        raise ValueError(f"Invalid topic {topic!r}")
+    problem = tween_unavailable(tween)
+    if problem:
+        raise ValueError(problem)
+    progress = progress or (lambda **fields: None)
+    await asyncio.gather(*(model.ensure_loaded() for model in models))
+    print('Starting movie generation...')
+    SOME_MAX_LENGTH = 72
+    keyframes = keyframe_numbers(total_frames, keyframe_every)
+
+    # Create a folder for the movie
+    movie_folder = os.path.join("movies", topic)
+    image_folder = os.path.join(movie_folder, "images")
+    os.makedirs(image_folder, exist_ok=True)
+
+    manifest_path = os.path.join(movie_folder, "manifest.json")
+    if os.path.exists(manifest_path) and (not resume or MovieManifest.is_finished(manifest_path)):
+        os.remove(manifest_path)
+
+    with seed_pool_lock:
+        seed = seed_pool.pop(0) if seed_pool else random.randint(0, 10000)
+    manifest = MovieManifest.load_or_create(manifest_path, topic, total_frames, seed, keyframes=keyframes)
+    prev_seed = manifest.seed
+
+    if manifest.completed_frames():
+        print(f"Resuming {topic}: {manifest.completed_frames()} of {len(keyframes)} keyframes already rendered")
+    progress(stage="generating", frames_done=0, total_frames=total_frames)
+
+    # Llama stage: write the text for a keyframe
+    async def write_frame(key):
+        record = manifest.frame(key)
+        if record["status"] != PENDING:
+            return record["text"]
+
+        frame = keyframes[key]
+        print(f"Processing frame {frame}...")
+
+        text_prompt = f"{context_info} Generate Story Frame for Frame Number: {frame} for Topic: {topic}\n"
+
+        generated_text = await chunk_and_generate(text_prompt, max_tokens=200, max_length=SOME_MAX_LENGTH, job=topic)
+        manifest.update(key, status=WRITTEN, text=generated_text)
+        return generated_text
+
+    # Frames are encoded as they render; save_every=N also keeps every Nth frame as PNG (0 = none)
+    movie_path = os.path.join(movie_folder, f"{topic}.mp4")
+    png_writer = PNGWriter()
+    sink = FFmpegVideoSink(movie_path, fps=24, png_pattern=os.path.join(image_folder, f"{{}}_{topic}.png"), png_every=save_every,
+                           png_writer=png_writer)
+
+    # The last keyframe written to the movie, as (frame number, image)
+    last_key = None
+
+    def write_tweens(start_frame, start_image, end_frame, end_image):
+        frames = tween_frames(start_image, end_image, end_frame - start_frame - 1, tween)
+        for offset, pixels in enumerate(frames, start=start_frame + 1):
+            sink.write(pixels, index=offset)
+
+    # SD stage: render keyframes while Llama writes the next ones. There is a
+    # single render worker, so frames reach the encoder in order.
+    async def render_frame(key, generated_text):
+        nonlocal prev_seed, last_key
+        frame = keyframes[key]
+        record = manifest.frame(key)
+
+        checkpointed = record["status"] == RENDERED and record["image"] and os.path.exists(record["image"])
+        if checkpointed:
+            # Feed the saved image to the encoder instead of rendering it again
+            image = Image.open(record["image"])
+            new_seed = record["seed"]
+        else:
+            # A keyframe rendered before but not kept on disk is rendered again with the same seed
+            images, new_seed = await generate_images(generated_text, record["seed"] or prev_seed)
+            if not images:
+                progress(frames_done=frame + 1)
+                return False
+            image = images[0]  # Use the first image in the list
+
+        # Fill the gap since the previous keyframe (including failed keyframes) off the event loop
+        pixels = image.image if isinstance(image, SDImage) else image
+        if last_key is not None and frame - last_key[0] > 1:
+            await asyncio.get_event_loop().run_in_executor(None, write_tweens, last_key[0], last_key[1], frame, pixels)
+        image_path = sink.write(image, index=frame, save=not checkpointed)
+        last_key = (frame, pixels)
+
+        prev_seed = new_seed  # Update the seed for the next iteration
+        if not checkpointed:
+            manifest.update(key, status=RENDERED, seed=new_seed, image=image_path)
+        progress(frames_done=frame + 1)
+        return True
+
+    with png_writer, sink:
+        rendered = await run_pipeline(len(keyframes), write_frame, render_frame, depth=pipeline_depth)
+        progress(stage="encoding")
+    storyline = "".join(manifest.frame(key)["text"] or "" for key in range(len(keyframes)))
+
+    if not any(rendered):
+        raise RuntimeError("No frames were rendered")
+
+    manifest.mark_finished()
+    return {"storyline": storyline, "movie_path": movie_path}
+
+
+# Runs of one topic share movies/<topic>/ (manifest, frames, mp4), so they take turns
+movie_locks = defaultdict(asyncio.Lock)
+
+
+async def make_movie(topic, *args, **kwargs):
+    async with movie_locks[topic]:
+        return await _make_movie(topic, *args, **kwargs)
+
+
+# Per-movie timing trace, written next to the movie when asked for
+def movie_trace(topic, enabled):
+    return metrics.trace(os.path.join("movies", topic, "trace.jsonl") if enabled else None)
+
+
+def check_topic(topic):
+    if not valid_topic(topic):
+        raise HTTPException(status_code=422, detail=f"Invalid topic {topic!r}: it names a folder, so it cannot be empty, '.', '..' or contain slashes")
+
+
+def check_tween(tween):
+    problem = tween_unavailable(tween)
+    if problem:
+        raise HTTPException(status_code=400, detail=problem)
+
+
 @app.get("/generate_movie/{topic}")
-async def generate_movie(topic: str):
+async def generate_movie(topic: str, pipeline_depth: int = Query(PIPELINE_DEPTH, ge=1), save_every: int = Query(1, ge=0), resume: bool = True,
+                         total_frames: int = Query(50, ge=2), keyframe_every: int = Query(1, ge=1), tween: str = "linear",
+                         trace: bool = False):
+    check_topic(topic)
+    check_tween(tween)
     try:
-        print('Starting movie generation...')
-        storyline = ""
-        total_frames = 50
-        SOME_MAX_LENGTH = 72
-
-        with seed_pool_lock:
-            prev_seed = seed_pool.pop(0)
-
-        # Create a folder for the movie
-        movie_folder = os.path.join("movies", topic)
-        image_folder = os.path.join(movie_folder, "images")
-        os.makedirs(image_folder, exist_ok=True)
-
-        for frame in range(total_frames):
-            print(f"Processing frame {frame}...")
-                       
-            text_prompt = f"{context_info} Generate Story Frame for Frame Number: {frame} for Topic: {topic}\n"
-            
-            generated_text = await chunk_and_generate(text_prompt, max_tokens=200, max_length=SOME_MAX_LENGTH)
-            
-            if generated_text:
-                storyline += generated_text
-
-            # Generate and save images for this frame
-            images, new_seed = await generate_images(generated_text, prev_seed)
-            if images:
-                image_path = os.path.join(image_folder, f"{frame}_{topic}.png")
-                images[0].save(image_path)  # Save the first image in the list
-                prev_seed = new_seed  # Update the seed for the next iteration
-
-        # After saving all the frames, generate the movie (This should be outside the loop)
-        image_files = [os.path.join(image_folder, f"{i}_{topic}.png") for i in range(total_frames)]
-        clip = ImageSequenceClip(image_files, fps=24)  # Adjust fps as needed
-        movie_path = os.path.join(movie_folder, f"{topic}.mp4")
-        clip.write_videofile(movie_path)
-
-        return JSONResponse(content={"message": "Movie generated successfully!", "storyline": storyline, "movie_path": movie_path})
+        with movie_trace(topic, trace):
+            movie = await make_movie(topic, pipeline_depth, save_every, resume, total_frames=total_frames,
+                                     keyframe_every=keyframe_every, tween=tween)
+        return JSONResponse(content={"message": "Movie generated successfully!", **movie})
 
+    except ServiceOverloaded as e:
+        logging.error(f"Error in generate_movie: {e}")
+        return JSONResponse(status_code=503, content={"message": "Too many movies are being generated, try again later.", "error": str(e)})
     except Exception as e:
         logging.error(f"Error in generate_movie: {e}")
         return JSONResponse(content={"message": "An error occurred while generating the movie.", "error": str(e)})
 
 
+class MovieJob(BaseModel):
+    topic: str
+    pipeline_depth: int = Field(PIPELINE_DEPTH, ge=1)
+    save_every: int = Field(1, ge=0)
+    total_frames: int = Field(50, ge=2)
+    keyframe_every: int = Field(1, ge=1)
+    tween: str = "linear"
+    trace: bool = False
+    resume: bool = True
+
+
+async def run_movie_job(params, progress, restarted=False):
+    # A job re-queued after a restart always continues from its manifest
+    resume = params.get("resume", True) or restarted
+    with movie_trace(params["topic"], params.get("trace", False)):
+        return await make_movie(params["topic"], params["pipeline_depth"], params["save_every"], resume=resume, progress=progress,
+                                total_frames=params.get("total_frames", 50), keyframe_every=params.get("keyframe_every", 1),
+                                tween=params.get("tween", "linear"))
+
+
+# Movies submitted through /jobs run in the background, at most MAX_CONCURRENT_MOVIES at a time
+# Its database (JOBS_DB_PATH, relative to the working directory) is opened at startup, not on import
+job_queue = JobQueue(run_movie_job, db_path=os.environ.get("JOBS_DB_PATH", "jobs.sqlite"), max_concurrent=MAX_CONCURRENT_MOVIES)
+
+
+@app.on_event("startup")
+async def start_job_queue():
+    if PRELOAD_MODELS:
+        for model in models:
+            model.load_in_background()
+    await job_queue.start()
+
+
+@app.on_event("shutdown")
+async def stop_job_queue():
+    await job_queue.stop()
+    inference.close()
+
+
+# Liveness: the process is up and serving requests, whether or not the models are loaded
+@app.get("/healthz")
+async def healthz():
+    return JSONResponse(content={"status": "ok"})
+
+
+# Readiness: every model is loaded and movies can be generated
+@app.get("/readyz")
+async def readyz():
+    ready, statuses = readiness(models)
+    return JSONResponse(status_code=200 if ready else 503, content={"ready": ready, "models": statuses})
+
+
+@app.post("/jobs")
+async def submit_job(job: MovieJob):
+    check_topic(job.topic)
+    check_tween(job.tween)
+    job_id = job_queue.submit(job.dict())
+    return JSONResponse(status_code=202, content={"job_id": job_id, "status_url": f"/jobs/{job_id}"})
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    job.pop("result")
+    return JSONResponse(content=job)
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    if job["status"] == "failed":
+        return JSONResponse(status_code=500, content={"message": "An error occurred while generating the movie.", "error": job["error"]})
+    if job["status"] != "done":
+        return JSONResponse(status_code=409, content={"message": f"Job is {job['status']}", "stage": job["stage"]})
+    return JSONResponse(content={"message": "Movie generated successfully!", **job["result"]})
+
+
+# Stage timings and counters in Prometheus text format, or as JSON with ?format=json
+@app.get("/metrics")
+async def metrics_endpoint(format: str = "prometheus"):
+    if format == "json":
+        return JSONResponse(content=metrics.snapshot())
+    return PlainTextResponse(metrics.prometheus(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/inference_stats")
+async def inference_stats():
+    return JSONResponse(content=inference.stats())
+
+
+@app.get("/sd_backends")
+async def sd_backends():
+    return JSONResponse(content={"backends": sd_client.client.stats()})
+
+
+@app.get("/render_cache")
+async def render_cache_stats():
+    return JSONResponse(content=sd_client.stats())
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
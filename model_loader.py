@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import threading
+import time
+
+
+class LazyModel:
+    """Load a model on first use instead of at import time.
+
+    `load()` builds the model; it runs at most once, on whichever thread first
+    needs the model, or on a background thread started by `load_in_background`.
+    The wrapper can stand in for the model itself: calls and attribute lookups
+    are forwarded to it, loading it first if necessary. A failed load is
+    reported by `status()` and retried on the next use.
+    """
+
+    def __init__(self, load, name="model"):
+        self.load = load
+        self.name = name
+        self.model = None
+        self.error = None
+        self.loading = False
+        self.load_seconds = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.model is not None
+
+    def get(self):
+        if self.model is not None:
+            return self.model
+        with self._lock:
+            if self.model is None:
+                self.loading = True
+                started = time.monotonic()
+                try:
+                    model = self.load()
+                except Exception as e:
+                    self.error = e
+                    raise
+                finally:
+                    self.loading = False
+                self.load_seconds = time.monotonic() - started
+                self.error = None
+                self.model = model
+                logging.info(f"Loaded {self.name} in {self.load_seconds:.1f}s")
+        return self.model
+
+    def load_in_background(self):
+        def run():
+            try:
+                self.get()
+            except Exception as e:
+                logging.error(f"Failed to load {self.name}: {e}")
+
+        thread = threading.Thread(target=run, name=f"load-{self.name}", daemon=True)
+        thread.start()
+        return thread
+
+    # Load without blocking the event loop
+    async def ensure_loaded(self):
+        if self.model is None:
+            await asyncio.get_event_loop().run_in_executor(None, self.get)
+        return self.model
+
+    def status(self):
+        if self.model is not None:
+            state = "ready"
+        elif self.loading:
+            state = "loading"
+        elif self.error is not None:
+            state = "failed"
+        else:
+            state = "not_loaded"
+        return {
+            "name": self.name,
+            "state": state,
+            "load_seconds": self.load_seconds,
+            "error": str(self.error) if self.error is not None else None,
+        }
+
+    def __call__(self, *args, **kwargs):
+        return self.get()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        # Only reached for attributes the wrapper itself doesn't have
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+
+# (ready, statuses) for a /readyz endpoint
+def readiness(models):
+    statuses = [model.status() for model in models]
+    return all(status["state"] == "ready" for status in statuses), statuses
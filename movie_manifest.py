@@ -0,0 +1,79 @@
+import json
+import os
+
+from metrics import metrics
+
+PENDING = "pending"
+WRITTEN = "written"
+RENDERED = "rendered"
+
+
+class MovieManifest:
+    """Checkpoint of a movie in progress, stored as JSON next to its frames.
+
+    Each frame records its text, the seed it was rendered with, the saved image
+    path and a status (pending, written, rendered). Only keyframes are recorded:
+    `keyframes` holds their frame numbers out of `total_frames`, and every frame
+    is a keyframe unless the movie fills the gaps with in-between frames.
+    The file is replaced atomically on every save so a crash never leaves it
+    half written. `finished` is set once the movie has been encoded.
+    """
+
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+
+    @classmethod
+    def load_or_create(cls, path, topic, total_frames, seed, keyframes=None):
+        keyframes = list(keyframes) if keyframes is not None else list(range(total_frames))
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            # Manifests from before keyframe mode have a frame for every movie frame
+            saved_keyframes = data.get("keyframes", list(range(data.get("total_frames", 0))))
+            if data.get("total_frames") == total_frames and saved_keyframes == keyframes:
+                return cls(path, data)
+        data = {
+            "topic": topic,
+            "total_frames": total_frames,
+            "keyframes": keyframes,
+            "seed": seed,
+            "frames": {str(i): {"status": PENDING, "text": None, "seed": None, "image": None} for i in range(len(keyframes))},
+        }
+        manifest = cls(path, data)
+        manifest.save()
+        return manifest
+
+    # Whether the manifest at `path` belongs to a movie that was completed
+    @staticmethod
+    def is_finished(path):
+        try:
+            with open(path) as f:
+                return bool(json.load(f).get("finished"))
+        except (OSError, ValueError):
+            return False
+
+    def mark_finished(self):
+        self.data["finished"] = True
+        self.save()
+
+    @property
+    def seed(self):
+        return self.data["seed"]
+
+    def frame(self, index):
+        return self.data["frames"][str(index)]
+
+    def update(self, index, **fields):
+        self.data["frames"][str(index)].update(fields)
+        self.save()
+
+    def completed_frames(self):
+        return sum(frame["status"] == RENDERED for frame in self.data["frames"].values())
+
+    @metrics.timed("manifest_save")
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=4)
+        os.replace(tmp_path, self.path)
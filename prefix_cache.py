@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import metrics
+
+
+# Memory a saved state really holds: the llama.cpp context plus the numpy
+# copies of input_ids and the logits (up to n_ctx x n_vocab floats)
+def state_bytes(state):
+    size = state.llama_state_size
+    for array in (getattr(state, "input_ids", None), getattr(state, "scores", None)):
+        size += getattr(array, "nbytes", 0)
+    return size
+
+
+def common_prefix(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class PrefixStateCache:
+    """Reuse the evaluated model state for fixed prompt prefixes.
+
+    Wraps a `llama_cpp.Llama` and is called the same way. When a prompt starts
+    with one of the registered `prefixes`, the state saved right after that
+    prefix was evaluated is loaded first, so llama_cpp only evaluates the rest
+    of the prompt, unless the model's live context already matches the prompt
+    at least as far: llama_cpp reuses that match by itself, and restoring
+    would throw it away.
+    States are built on first use and kept in an LRU bounded by `max_bytes`.
+    Calls are serialised because the model is not thread safe.
+    """
+
+    def __init__(self, llm, prefixes=(), max_bytes=512 * 1024 * 1024):
+        self.llm = llm
+        self.prefixes = sorted(prefixes, key=len, reverse=True)
+        self.max_bytes = max_bytes
+        self.states = OrderedDict()
+        self.prefix_tokens = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.live = 0
+        self._lock = threading.RLock()
+
+    def add_prefix(self, prefix):
+        with self._lock:
+            if prefix not in self.prefixes:
+                self.prefixes = sorted(self.prefixes + [prefix], key=len, reverse=True)
+
+    def _state_for(self, prefix):
+        if prefix in self.states:
+            self.states.move_to_end(prefix)
+            self.hits += 1
+            metrics.inc("llama_prefix_hits")
+            return self.states[prefix]
+
+        self.misses += 1
+        metrics.inc("llama_prefix_misses")
+        with metrics.timer("llama_prefix_eval"):
+            self.llm.reset()
+            self.llm.eval(self._tokens_for(prefix))
+            state = self.llm.save_state()
+        size = state_bytes(state)
+        if size > self.max_bytes:
+            logging.warning(f"Prefix state of {size} bytes exceeds the cache limit, not keeping it")
+            return state
+
+        self.states[prefix] = state
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self.states.popitem(last=False)
+            self.total_bytes -= state_bytes(evicted)
+        return state
+
+    def _tokens_for(self, prefix):
+        tokens = self.prefix_tokens.get(prefix)
+        if tokens is None:
+            tokens = self.prefix_tokens[prefix] = list(self.llm.tokenize(prefix.encode("utf-8"), add_bos=True))
+        return tokens
+
+    # Length of the common start of the model's context and `tokens`
+    def _live_match(self, tokens):
+        input_ids = getattr(self.llm, "input_ids", None)
+        if input_ids is None:
+            return 0
+        return common_prefix(input_ids[:self.llm.n_tokens], tokens)
+
+    def _load_prefix(self, prompt):
+        prefix = next((p for p in self.prefixes if prompt.startswith(p)), None)
+        if prefix is not None:
+            # Tokens can merge across the end of the prefix, so compare against the prompt's own tokens
+            tokens = self.llm.tokenize(prompt.encode("utf-8"), add_bos=True)
+            if self._live_match(tokens) >= common_prefix(self._tokens_for(prefix), tokens):
+                self.live += 1
+                metrics.inc("llama_prefix_live")
+                return
+            state = self._state_for(prefix)
+            with metrics.timer("llama_prefix_restore"):
+                self.llm.load_state(state)
+
+    def __call__(self, prompt, **kwargs):
+        with self._lock:
+            self._load_prefix(prompt)
+            with metrics.timer("llama_completion"):
+                output = self.llm(prompt, **kwargs)
+            usage = output.get("usage") or {}
+            metrics.inc("llama_prompt_tokens", usage.get("prompt_tokens", 0))
+            metrics.inc("llama_tokens", usage.get("completion_tokens", 0))
+            return output
+
+    # Streamed completion; the lock is held until the stream is exhausted or
+    # closed, so iterate it on a single thread. Time to the first chunk is
+    # recorded as prompt evaluation, the rest as generation.
+    def stream(self, prompt, **kwargs):
+        with self._lock:
+            self._load_prefix(prompt)
+            started = time.perf_counter()
+            first = None
+            chunks = 0
+            try:
+                for chunk in self.llm(prompt, stream=True, **kwargs):
+                    if first is None:
+                        first = time.perf_counter()
+                        metrics.observe("llama_prompt_eval", first - started)
+                    chunks += 1
+                    yield chunk
+            finally:
+                if first is not None:
+                    metrics.observe("llama_generate", time.perf_counter() - first)
+                metrics.inc("llama_tokens", chunks)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "live": self.live,
+                "prefixes_cached": len(self.states),
+                "bytes": self.total_bytes,
+            }
@@ -0,0 +1,69 @@
+import threading
+
+
+class PromptBudgeter:
+    """Fit prompts into a token budget measured with the model's own tokenizer.
+
+    Token counts include the BOS token llama_cpp adds to every prompt. Fixed
+    prefixes passed as `prefixes` (instructions repeated on every call) are
+    tokenized once; a prompt starting with one only has its remainder
+    tokenized. Over-long prompts keep the prefix and lose tokens from the start
+    or end of the remainder in a single cut. Prefixes are tokenized on first
+    use, so creating a budgeter doesn't load a lazily loaded model.
+    """
+
+    def __init__(self, llm, prefixes=()):
+        self.llm = llm
+        self._prefix_tokens = {}
+        self._pending = list(prefixes)
+        self._pending_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    def tokenize(self, text, add_bos=False):
+        return self.llm.tokenize(text.encode("utf-8"), add_bos=add_bos)
+
+    def detokenize(self, tokens):
+        return self.llm.detokenize(tokens).decode("utf-8", errors="ignore")
+
+    def count(self, text):
+        return len(self.tokenize(text, add_bos=True))
+
+    def add_prefix(self, prefix):
+        tokens = self.tokenize(prefix, add_bos=True)
+        with self._lock:
+            self._prefix_tokens[prefix] = tokens
+        return tokens
+
+    def _split(self, prompt):
+        if self._pending:
+            with self._pending_lock:
+                while self._pending:
+                    self.add_prefix(self._pending.pop())
+        with self._lock:
+            prefixes = sorted(self._prefix_tokens, key=len, reverse=True)
+            for prefix in prefixes:
+                if prompt.startswith(prefix):
+                    return prefix, self._prefix_tokens[prefix], prompt[len(prefix):]
+        return "", [], prompt
+
+    def fit(self, prompt, budget, keep="start"):
+        prefix, prefix_tokens, rest = self._split(prompt)
+        if not prefix:
+            # No known prefix; the BOS token still counts
+            prefix_tokens = self.tokenize("", add_bos=True)
+        rest_tokens = self.tokenize(rest)
+
+        # Tokenizing the two halves separately can differ from the whole prompt by
+        # a token at the seam, so anything close to the budget is checked once
+        room = budget - len(prefix_tokens)
+        if len(rest_tokens) < room:
+            return prompt
+        if room <= 0:
+            raise ValueError(f"Prompt prefix alone needs {len(prefix_tokens)} of {budget} tokens")
+
+        rest_tokens = rest_tokens[:room] if keep == "start" else rest_tokens[-room:]
+        fitted = prefix + self.detokenize(rest_tokens)
+        if self.count(fitted) > budget:
+            rest_tokens = rest_tokens[:-1] if keep == "start" else rest_tokens[1:]
+            fitted = prefix + self.detokenize(rest_tokens)
+        return fitted
@@ -0,0 +1,171 @@
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+
+from metrics import metrics
+from sd_client import IMG2IMG, TXT2IMG
+
+# Payload fields SD reads as numbers; "7" and 7 render the same image
+NUMERIC_FIELDS = {"seed", "subseed", "subseed_strength", "steps", "cfg_scale", "width", "height",
+                  "denoising_strength", "batch_size", "n_iter"}
+
+
+def canonical_payload(endpoint, payload):
+    fields = {}
+    for key, value in payload.items():
+        if key in NUMERIC_FIELDS and isinstance(value, str):
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        fields[key] = value
+    return json.dumps({"endpoint": endpoint, "payload": fields}, sort_keys=True, separators=(",", ":"))
+
+
+def payload_key(endpoint, payload):
+    return hashlib.blake2b(canonical_payload(endpoint, payload).encode("utf-8"), digest_size=20).hexdigest()
+
+
+# Only a fixed seed makes a render repeatable; -1 or no seed means SD picks one
+def is_deterministic(payload):
+    def random_seed(value):
+        try:
+            return int(float(value)) == -1
+        except (TypeError, ValueError):
+            return True
+
+    if random_seed(payload.get("seed")):
+        return False
+    if float(payload.get("subseed_strength") or 0) and random_seed(payload.get("subseed")):
+        return False
+    return True
+
+
+class RenderCache:
+    """Content-addressed cache of SD responses in front of an SD client.
+
+    Wraps an `SDClient` or `SDScheduler` and is used the same way. Responses to
+    payloads with a fixed seed are stored in SQLite at `db_path`, keyed by a
+    hash of the canonical payload and zlib-compressed; payloads SD would seed
+    randomly always go to the client. Once the stored responses exceed
+    `max_bytes` the least recently used ones are evicted.
+    """
+
+    def __init__(self, client, db_path="render_cache.sqlite", max_bytes=2 * 1024 ** 3):
+        self.client = client
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS renders (key TEXT PRIMARY KEY, response BLOB, size INTEGER, last_used REAL)''')
+            self.conn.execute("CREATE INDEX IF NOT EXISTS renders_last_used ON renders (last_used)")
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM renders").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+        self.client.close()
+
+    def get(self, key):
+        with self._lock:
+            row = self.conn.execute("SELECT response FROM renders WHERE key=?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.inc("render_cache_misses")
+                return None
+            with self.conn:
+                self.conn.execute("UPDATE renders SET last_used=? WHERE key=?", (time.time(), key))
+            self.hits += 1
+        metrics.inc("render_cache_hits")
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key, response):
+        blob = zlib.compress(json.dumps(response, separators=(",", ":")).encode("utf-8"), 1)
+        if len(blob) > self.max_bytes:
+            return
+        with self._lock, self.conn:
+            old = self.conn.execute("SELECT size FROM renders WHERE key=?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO renders VALUES (?, ?, ?, ?)", (key, blob, len(blob), time.time()))
+            self.total_bytes += len(blob) - (old[0] if old else 0)
+            while self.total_bytes > self.max_bytes:
+                evict = []
+                for old_key, size in self.conn.execute("SELECT key, size FROM renders ORDER BY last_used LIMIT 32").fetchall():
+                    evict.append((old_key,))
+                    self.total_bytes -= size
+                    if self.total_bytes <= self.max_bytes:
+                        break
+                self.conn.executemany("DELETE FROM renders WHERE key=?", evict)
+                self.evicted += len(evict)
+
+    def _lookup(self, endpoint, payload):
+        if not is_deterministic(payload):
+            with self._lock:
+                self.bypassed += 1
+            return None, None
+        key = payload_key(endpoint, payload)
+        return key, self.get(key)
+
+    def _store(self, key, response):
+        try:
+            self.put(key, response)
+        except sqlite3.Error as e:
+            logging.error(f"Error caching SD response: {e}")
+
+    def post(self, endpoint, payload):
+        key, response = self._lookup(endpoint, payload)
+        if response is not None:
+            return response
+        response = self.client.post(endpoint, payload)
+        if key is not None:
+            self._store(key, response)
+        return response
+
+    async def apost(self, endpoint, payload):
+        loop = asyncio.get_event_loop()
+        key, response = await loop.run_in_executor(None, self._lookup, endpoint, payload)
+        if response is not None:
+            return response
+        response = await self.client.apost(endpoint, payload)
+        if key is not None:
+            await loop.run_in_executor(None, self._store, key, response)
+        return response
+
+    def txt2img(self, payload):
+        return self.post(TXT2IMG, payload)
+
+    def img2img(self, payload):
+        return self.post(IMG2IMG, payload)
+
+    async def atxt2img(self, payload):
+        return await self.apost(TXT2IMG, payload)
+
+    async def aimg2img(self, payload):
+        return await self.apost(IMG2IMG, payload)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "bypassed": self.bypassed,
+                "evicted": self.evicted,
+                "entries": self.conn.execute("SELECT COUNT(*) FROM renders").fetchone()[0],
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+            }
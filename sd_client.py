@@ -0,0 +1,99 @@
+import asyncio
+import contextvars
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import metrics
+
+SD_URL = "http://127.0.0.1:7860"
+TXT2IMG = "/sdapi/v1/txt2img"
+IMG2IMG = "/sdapi/v1/img2img"
+
+# Status codes worth retrying: SD is busy, restarting or behind a proxy hiccup
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class SDError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class SDClient:
+    """Pooled client for one Stable Diffusion web API backend.
+
+    The sync methods (`txt2img`, `img2img`) block the calling thread; the async
+    ones (`atxt2img`, `aimg2img`) run the same request on the client's own
+    worker threads so they never block an event loop. Both share one keep-alive
+    connection pool and one concurrency limit.
+    """
+
+    def __init__(self, base_url=SD_URL, max_concurrency=2, timeout=(5, 600), retries=3, backoff=0.5):
+        self.base_url = base_url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="sd-client")
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.session.close()
+
+    def post(self, endpoint, payload):
+        url = self.base_url + endpoint
+        attempt = 0
+        while True:
+            try:
+                with self._slots, metrics.timer("sd_request", endpoint=endpoint):
+                    response = self.session.post(url, json=payload, timeout=self.timeout)
+                if response.status_code == 200:
+                    with metrics.timer("sd_parse"):
+                        return response.json()
+                error = SDError(f"{url} returned {response.status_code}", response.status_code)
+                if response.status_code not in RETRY_STATUSES:
+                    raise error
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = SDError(f"{url} failed: {e}")
+            except ValueError as e:
+                raise SDError(f"{url} returned invalid JSON: {e}")
+
+            metrics.inc("sd_errors")
+            attempt += 1
+            if attempt > self.retries:
+                raise error
+            metrics.inc("sd_retries")
+            delay = self.backoff * (2 ** (attempt - 1)) * (1 + random.random())
+            logging.warning(f"{error}, retrying in {delay:.1f}s ({attempt}/{self.retries})")
+            time.sleep(delay)
+
+    def txt2img(self, payload):
+        return self.post(TXT2IMG, payload)
+
+    def img2img(self, payload):
+        return self.post(IMG2IMG, payload)
+
+    async def apost(self, endpoint, payload):
+        loop = asyncio.get_event_loop()
+        # Carry the caller's context (e.g. its metrics trace) into the worker thread
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._executor, context.run, self.post, endpoint, payload)
+
+    async def atxt2img(self, payload):
+        return await self.apost(TXT2IMG, payload)
+
+    async def aimg2img(self, payload):
+        return await self.apost(IMG2IMG, payload)
@@ -0,0 +1,126 @@
+import binascii
+import concurrent.futures
+import contextvars
+import io
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from metrics import metrics
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+# SD sends bare base64; some proxies wrap it in a data URL
+def b64_payload(data):
+    if data.startswith("data:"):
+        return data[data.index(",") + 1:]
+    return data
+
+
+class SDImage:
+    """One image from an SD response, decoded once.
+
+    `image` is the loaded RGB PIL image, meant to be handed as is to the scorer,
+    the video sink and anything else that needs pixels. `png` holds the bytes
+    SD sent, so saving a PNG is a plain file write instead of a re-encode.
+    """
+
+    __slots__ = ("png", "image")
+
+    def __init__(self, png):
+        self.png = png
+        image = Image.open(io.BytesIO(png))
+        image.load()
+        self.image = image if image.mode == "RGB" else image.convert("RGB")
+
+    @property
+    def size(self):
+        return self.image.size
+
+    def save(self, path):
+        if path.lower().endswith(".png") and self.png.startswith(PNG_SIGNATURE):
+            with open(path, "wb") as f:
+                f.write(self.png)
+        else:
+            self.image.save(path)
+
+
+def decode_image(data):
+    with metrics.timer("sd_decode"):
+        return SDImage(binascii.a2b_base64(b64_payload(data)))
+
+
+def decode_images(response):
+    return [decode_image(data) for data in response.get("images", [])]
+
+
+class PNGWriter:
+    """Save images on a background thread.
+
+    `write(path, image)` queues the save and returns at once; at most
+    `max_pending` saves wait at a time, after which `write` blocks so a slow
+    disk holds back the producer instead of piling up frames in memory. Files
+    appear atomically under their final name. `flush()` waits for everything
+    queued so far.
+    """
+
+    def __init__(self, max_pending=16):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="png-writer")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self.written = 0
+        self.failed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _save(self, path, image):
+        root, ext = os.path.splitext(path)
+        tmp_path = f"{root}.tmp{ext}"
+        started = time.perf_counter()
+        try:
+            if isinstance(image, (SDImage, Image.Image)):
+                image.save(tmp_path)
+            else:
+                Image.fromarray(np.asarray(image, dtype=np.uint8)).save(tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logging.error(f"Failed to save {path}: {e}")
+            with self._lock:
+                self.failed += 1
+            raise
+        with self._lock:
+            self.written += 1
+        metrics.observe("png_write", time.perf_counter() - started)
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+        self._slots.release()
+
+    def write(self, path, image):
+        with metrics.timer("png_write_wait"):
+            self._slots.acquire()
+        future = self._executor.submit(contextvars.copy_context().run, self._save, path, image)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def flush(self):
+        with self._lock:
+            pending = list(self._pending)
+        concurrent.futures.wait(pending)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
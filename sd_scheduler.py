@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+from metrics import metrics
+from sd_client import IMG2IMG, RETRY_STATUSES, SD_URL, TXT2IMG, SDClient, SDError
+
+
+class Backend:
+    def __init__(self, url, max_concurrency):
+        self.url = url
+        self.client = SDClient(url, max_concurrency=max_concurrency, retries=0)
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.consecutive_failures = 0
+        self.avg_latency = None  # exponentially weighted, seconds
+        self.unhealthy_until = 0.0
+
+    def healthy(self, now):
+        return now >= self.unhealthy_until
+
+    def load(self):
+        # Expected time until a new job here would finish: queue position times
+        # typical render time. Unmeasured backends are tried first.
+        latency = self.avg_latency if self.avg_latency is not None else 0.0
+        return (self.in_flight + 1) / self.max_concurrency * latency, self.in_flight
+
+
+class SDScheduler:
+    """Spread SD render jobs over several backends.
+
+    Has the same `txt2img`/`img2img`/`atxt2img`/`aimg2img` methods as
+    `SDClient`, so callers can use either. Each job goes to the healthy backend
+    with the lowest expected completion time; a backend that fails
+    `max_failures` times in a row is benched for `cooldown` seconds and its job
+    is retried on another backend. Once every backend has failed a job, it
+    waits with exponential backoff and tries them all again, up to `retries`
+    more rounds, so a single backend still gets `SDClient`'s retries. Speed
+    only steers new jobs; a job already running on a slow backend stays there.
+    """
+
+    def __init__(self, urls=None, max_concurrency=2, max_failures=3, cooldown=30.0, smoothing=0.3, retries=3, backoff=0.5):
+        urls = urls or [SD_URL]
+        self.backends = [Backend(url, max_concurrency) for url in urls]
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.smoothing = smoothing
+        self.retries = retries
+        self.backoff = backoff
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, **kwargs):
+        # SD_BACKENDS="http://127.0.0.1:7860,http://127.0.0.1:7861"
+        urls = [url.strip() for url in os.environ.get("SD_BACKENDS", SD_URL).split(",") if url.strip()]
+        return cls(urls, **kwargs)
+
+    def close(self):
+        for backend in self.backends:
+            backend.client.close()
+
+    def _acquire(self, exclude):
+        with self._lock:
+            now = time.monotonic()
+            candidates = [b for b in self.backends if b not in exclude]
+            if not candidates:
+                return None
+            healthy = [b for b in candidates if b.healthy(now)]
+            if healthy:
+                backend = min(healthy, key=Backend.load)
+            else:
+                # Everything is benched: try the one that comes back soonest
+                backend = min(candidates, key=lambda b: b.unhealthy_until)
+            backend.in_flight += 1
+            return backend
+
+    def _release(self, backend, elapsed, error=None):
+        with self._lock:
+            backend.in_flight -= 1
+            if error is None:
+                backend.completed += 1
+                backend.consecutive_failures = 0
+                backend.unhealthy_until = 0.0
+                if backend.avg_latency is None:
+                    backend.avg_latency = elapsed
+                else:
+                    backend.avg_latency += self.smoothing * (elapsed - backend.avg_latency)
+                return
+            backend.failed += 1
+            backend.consecutive_failures += 1
+            if backend.consecutive_failures >= self.max_failures:
+                backend.unhealthy_until = time.monotonic() + self.cooldown
+                logging.warning(f"SD backend {backend.url} benched for {self.cooldown}s after {backend.consecutive_failures} failures")
+
+    @staticmethod
+    def _should_fail_over(error):
+        # A 4xx means the payload is bad, another backend won't do better
+        return error.status_code is None or error.status_code in RETRY_STATUSES
+
+    # Seconds to wait before another round over all backends, or None when out of retries
+    def _retry_delay(self, rounds, error):
+        if rounds > self.retries:
+            return None
+        metrics.inc("sd_retries")
+        delay = self.backoff * (2 ** (rounds - 1)) * (1 + random.random())
+        logging.warning(f"All SD backends failed ({error}), retrying in {delay:.1f}s ({rounds}/{self.retries})")
+        return delay
+
+    def post(self, endpoint, payload):
+        tried = set()
+        rounds = 0
+        last_error = None
+        while True:
+            backend = self._acquire(tried)
+            if backend is None:
+                rounds += 1
+                delay = self._retry_delay(rounds, last_error)
+                if delay is None:
+                    raise last_error
+                time.sleep(delay)
+                tried.clear()
+                continue
+            tried.add(backend)
+            start = time.monotonic()
+            try:
+                result = backend.client.post(endpoint, payload)
+            except SDError as e:
+                self._release(backend, time.monotonic() - start, e)
+                if not self._should_fail_over(e):
+                    raise
+                logging.warning(f"SD backend {backend.url} failed, moving job: {e}")
+                last_error = e
+                continue
+            self._release(backend, time.monotonic() - start)
+            return result
+
+    async def apost(self, endpoint, payload):
+        tried = set()
+        rounds = 0
+        last_error = None
+        while True:
+            backend = self._acquire(tried)
+            if backend is None:
+                rounds += 1
+                delay = self._retry_delay(rounds, last_error)
+                if delay is None:
+                    raise last_error
+                await asyncio.sleep(delay)
+                tried.clear()
+                continue
+            tried.add(backend)
+            start = time.monotonic()
+            try:
+                result = await backend.client.apost(endpoint, payload)
+            except SDError as e:
+                self._release(backend, time.monotonic() - start, e)
+                if not self._should_fail_over(e):
+                    raise
+                logging.warning(f"SD backend {backend.url} failed, moving job: {e}")
+                last_error = e
+                continue
+            self._release(backend, time.monotonic() - start)
+            return result
+
+    def txt2img(self, payload):
+        return self.post(TXT2IMG, payload)
+
+    def img2img(self, payload):
+        return self.post(IMG2IMG, payload)
+
+    async def atxt2img(self, payload):
+        return await self.apost(TXT2IMG, payload)
+
+    async def aimg2img(self, payload):
+        return await self.apost(IMG2IMG, payload)
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            elapsed = max(now - self.started, 1e-9)
+            return [
+                {
+                    "url": b.url,
+                    "healthy": b.healthy(now),
+                    "in_flight": b.in_flight,
+                    "completed": b.completed,
+                    "failed": b.failed,
+                    "avg_latency": b.avg_latency,
+                    "throughput_per_min": b.completed / elapsed * 60,
+                }
+                for b in self.backends
+            ]
@@ -0,0 +1,74 @@
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class SQLiteLRU:
+    """Values stored in a SQLite table, with an in-process LRU in front.
+
+    Rows of `table` in the database at `db_path` are keyed by the TEXT
+    `key_columns` and hold one `value_column` of `value_type`. Keys are tuples
+    in `key_columns` order. The `max_entries` most recently used values are
+    kept in memory; misses fall through to the table.
+    """
+
+    def __init__(self, db_path, table, key_columns, value_column, value_type="TEXT", max_entries=4096):
+        self.table = table
+        self.key_columns = list(key_columns)
+        self.value_column = value_column
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        columns = ", ".join(f"{column} TEXT" for column in self.key_columns)
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns}, {value_column} {value_type}, "
+                          f"PRIMARY KEY ({', '.join(self.key_columns)}))")
+        self.conn.commit()
+        self._select = (f"SELECT {value_column} FROM {table} WHERE "
+                        + " AND ".join(f"{column}=?" for column in self.key_columns))
+        self._insert = (f"INSERT OR REPLACE INTO {table} ({', '.join(self.key_columns)}, {value_column}) "
+                        f"VALUES ({', '.join('?' for _ in range(len(self.key_columns) + 1))})")
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+            row = self.conn.execute(self._select, key).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, row[0])
+            return row[0]
+
+    # Store (key, value) pairs in one transaction
+    def put_many(self, entries):
+        with self._lock:
+            for key, value in entries:
+                self._remember(key, value)
+            self.conn.executemany(self._insert, [(*key, value) for key, value in entries])
+            self.conn.commit()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "memory_entries": len(self.memory),
+            }
@@ -1,10 +1,15 @@
 from fastapi import FastAPI, Path
-import asyncio
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import json
 import os
 import logging
-from concurrent.futures import ThreadPoolExecutor
-from llama_cpp import Llama
+import time
+from frame_log import FrameLog, compact, read_frames
+from inference_service import InferenceService, ServiceOverloaded
+from metrics import metrics
+from model_loader import LazyModel, readiness
+from prefix_cache import PrefixStateCache
+from prompt_budget import PromptBudgeter
 
 # Initialize logging to debug level to capture detailed logs
 logging.basicConfig(level=logging.DEBUG)
@@ -12,28 +17,43 @@ logging.basicConfig(level=logging.DEBUG)
 # Create an instance of the FastAPI class
 app = FastAPI()
 
-# Initialize the Llama2 model
+# The Llama2 model is loaded on first use or in the background at startup, not at import;
+# the mmapped model file is shared by all worker processes through the page cache
 script_dir = os.path.dirname(os.path.realpath(__file__))
 model_path = os.path.join(script_dir, "llama-2-7b.ggmlv3.q8_0.bin")
-llm = Llama(model_path=model_path, n_ctx=2000)
-executor = ThreadPoolExecutor(max_workers=3)
 
-# Function to trim tokens in a string to fit within a given limit
-def trim_tokens(text, max_tokens):
-    tokens = text.split()
-    while len(tokens) > max_tokens:
-        tokens.pop(0)  # Remove the first token
-    return ' '.join(tokens)
+def load_llama():
+    from llama_cpp import Llama
+    return Llama(model_path=model_path, n_ctx=2000, use_mmap=os.environ.get("LLAMA_USE_MMAP", "1") != "0")
+
+llm = LazyModel(load_llama, name="llama")
+
+pre_prompt = "Based on the previous context, generate a concise and relevant continuation. Limit your output to 2-3 sentences."
+
+space_ai_rules = "As an AI specialized in Advanced Space Movies, you are tasked with generating a scene description. "
+
+# Measures and trims prompts with the model's own tokenizer; pre_prompt is tokenized once
+budgeter = PromptBudgeter(llm, prefixes=[pre_prompt])
+
+# Scene prompts share pre_prompt and the space rules, so their evaluated state is cached and restored
+cached_llm = PrefixStateCache(llm, prefixes=[pre_prompt, f"{pre_prompt} {space_ai_rules.rstrip()}"])
+
+# The model runs on one dedicated thread; concurrent movies take turns per topic
+inference = InferenceService([cached_llm], max_queue=int(os.environ.get("LLAMA_MAX_QUEUE", 16)))
 
 # Asynchronous function to generate text using the Llama2 model
-async def llama_generate_async(prompt):
-    loop = asyncio.get_event_loop()
-    pre_prompt = "Based on the previous context, generate a concise and relevant continuation. Limit your output to 2-3 sentences."
+async def llama_generate_async(prompt, job="default"):
+    await llm.ensure_loaded()
     full_prompt = f"{pre_prompt} {prompt}"
-    trimmed_prompt = trim_tokens(full_prompt, 990)
+
+    # Runs on the model's thread, so the tokenizer is never used while it generates
+    def complete():
+        # Keep the instructions and the most recent context, leaving room for the reply
+        trimmed_prompt = budgeter.fit(full_prompt, llm.n_ctx() - 499, keep="end")
+        return inference(trimmed_prompt, max_tokens=499)
     
     try:
-        output = await loop.run_in_executor(executor, lambda: llm(trimmed_prompt, max_tokens=499))
+        output = await inference.run(complete, job=job)
         return output['choices'][0]['text']
     except ValueError as e:
         logging.error(f"Token limit exceeded: {e}")
@@ -42,7 +62,7 @@ async def llama_generate_async(prompt):
 # Function to construct the initial prompt for the Multiverse Movie Generator Game
 async def construct_initial_prompt(topic):
     rules_prompt = f"Create a writing story prompt to start a Multiverse Movie Generator Game about {topic}."
-    initial_prompt = await llama_generate_async(rules_prompt)
+    initial_prompt = await llama_generate_async(rules_prompt, job=topic)
     return initial_prompt
 
 # Function to extract key topics from a frame
@@ -50,58 +70,130 @@ def extract_key_topics(frame):
     return ' '.join(frame.split()[-3:])
 
 # Function to continue the next frame generation
-async def continue_next_frame_generation(last_three_frames):
+async def continue_next_frame_generation(last_three_frames, job="default"):
     # Extract key topics from the last three frames
     key_topics = [extract_key_topics(frame) for frame in last_three_frames]
     combined_key_topics = ' '.join(key_topics)
     
     # Generate a new scene description based on the key topics
-    rules_prompt = ("As an AI specialized in Advanced Space Movies, you are tasked with generating a scene description. "
+    rules_prompt = (space_ai_rules +
                     f"Generate a scene based on these key topics: {combined_key_topics}")
-    new_frame_generation = await llama_generate_async(rules_prompt)
+    new_frame_generation = await llama_generate_async(rules_prompt, job=job)
     
     return new_frame_generation
 
-async def generate_advanced_space_scene():
-    rules_prompt = ("As an AI specialized in Advanced Space Movies, you are tasked with generating a scene description. "
+async def generate_advanced_space_scene(job="default"):
+    rules_prompt = (space_ai_rules +
                     "1. Stay in character as a specialized AI for Advanced Space Movies. "
                     "2. Generate an 18-word description of an advanced space scene.")
-    scene_output = await llama_generate_async(rules_prompt)
+    scene_output = await llama_generate_async(rules_prompt, job=job)
     return scene_output
 
 # FastAPI endpoint to start the Multiverse Movie Generator Game
 @app.get("/movie/{topic}", tags=["movie"])
-async def start_movie(topic: str = Path(..., description="The topic of the movie")):
+async def start_movie(topic: str = Path(..., description="The topic of the movie"), resume: bool = True, trace: bool = False):
+    sanitized_topic = ''.join(e for e in topic if e.isalnum())[:50]
+    # With trace, every timing recorded for this movie is also written to a JSONL file
+    with metrics.trace(f"{sanitized_topic}_trace.jsonl" if trace else None):
+        return await generate_movie_frames(topic, sanitized_topic, resume)
+
+# Generate the frames of a movie, resuming from its frame log when asked to
+async def generate_movie_frames(topic, sanitized_topic, resume):
     try:
-        # Initial prompt with rules
-        initial_prompt = await construct_initial_prompt(topic)
-        
+        frames_path = f"{sanitized_topic}_movie_frames.json"
+        log_path = f"{sanitized_topic}_movie_frames.jsonl"
+
+        # Frames are appended to a JSONL log as they are generated; the log is the
+        # checkpoint and is compacted into the frames JSON at the end
         frames = {}
-        frames["frame_0"] = initial_prompt
-        last_three_frames = [initial_prompt, "", ""]
-        
-        for i in range(1, 500):
-            # Generate advanced space movie scene description
-            advanced_space_scene = await generate_advanced_space_scene()
-            
-            # Continue next frame generation
-            new_frame_generation = await continue_next_frame_generation([advanced_space_scene, last_three_frames[-1]])
-            
-            frames[f"frame_{i}"] = new_frame_generation
-            last_three_frames.pop(0)
-            last_three_frames.append(new_frame_generation)
+        if not resume and os.path.exists(log_path):
+            os.remove(log_path)
+        if resume:
+            frames = dict(read_frames(log_path))
+            if not frames and os.path.exists(frames_path):
+                # Pick up runs checkpointed before the log existed
+                with open(frames_path) as f:
+                    frames = json.load(f)
+                with FrameLog(log_path) as frame_log:
+                    for key, text in frames.items():
+                        frame_log.append(key, text)
+            if frames:
+                logging.info(f"Resuming {topic} from {len(frames)} saved frames")
+
+        with FrameLog(log_path) as frame_log:
+            if "frame_0" not in frames:
+                # Initial prompt with rules
+                frames = {"frame_0": await construct_initial_prompt(topic)}
+                frame_log.append("frame_0", frames["frame_0"])
 
-            sanitized_topic = ''.join(e for e in topic if e.isalnum())
-            sanitized_topic = sanitized_topic[:50]
+            # Continue from the first missing frame with the last three frames as context
+            start = len(frames)
+            if start == 1:
+                last_three_frames = [frames["frame_0"], "", ""]
+            else:
+                last_three_frames = [frames.get(f"frame_{i}", "") for i in range(start - 3, start)]
             
-            with open(f"{sanitized_topic}_movie_frames.json", "w") as f:
-                json.dump(frames, f, indent=4)
+            for i in range(start, 500):
+                frame_started = time.perf_counter()
+                # Generate advanced space movie scene description
+                advanced_space_scene = await generate_advanced_space_scene(job=topic)
+                
+                # Continue next frame generation
+                new_frame_generation = await continue_next_frame_generation([advanced_space_scene, last_three_frames[-1]], job=topic)
+                
+                frames[f"frame_{i}"] = new_frame_generation
+                frame_log.append(f"frame_{i}", new_frame_generation)
+                last_three_frames.pop(0)
+                last_three_frames.append(new_frame_generation)
+                metrics.observe("frame", time.perf_counter() - frame_started)
+
+        compact(log_path, frames_path)
         
-        return {"message": f"Advanced Space Movie about {topic} started and 11 frames generated. Saved to {sanitized_topic}_movie_frames.json"}
+        return {"message": f"Advanced Space Movie about {topic} started and 11 frames generated. Saved to {frames_path}"}
+    except ServiceOverloaded as e:
+        logging.error(f"Model is overloaded: {e}")
+        return {"message": "Too many movies are being generated, try again later"}
     except Exception as e:
         logging.error(f"An error occurred: {e}")
         return {"message": "An error occurred during movie generation"}
 
+# Stream the frames generated so far, one JSON object per line, while a movie is still running
+@app.get("/movie/{topic}/frames", tags=["movie"])
+async def stream_frames(topic: str = Path(..., description="The topic of the movie")):
+    sanitized_topic = ''.join(e for e in topic if e.isalnum())[:50]
+    log_path = f"{sanitized_topic}_movie_frames.jsonl"
+    lines = (json.dumps({"frame": key, "text": text}) + "\n" for key, text in read_frames(log_path))
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+# Start loading the model without holding up startup
+@app.on_event("startup")
+async def preload_model():
+    if os.environ.get("PRELOAD_MODELS", "1") != "0":
+        llm.load_in_background()
+
+# Liveness: the server is up, the model may still be loading
+@app.get("/healthz", tags=["health"])
+async def healthz():
+    return {"status": "ok"}
+
+# Readiness: the model is loaded and movies can be generated
+@app.get("/readyz", tags=["health"])
+async def readyz():
+    ready, statuses = readiness([llm])
+    return JSONResponse(status_code=200 if ready else 503, content={"ready": ready, "models": statuses})
+
+# Stage timings and counters in Prometheus text format, or as JSON with ?format=json
+@app.get("/metrics", tags=["health"])
+async def metrics_endpoint(format: str = "prometheus"):
+    if format == "json":
+        return metrics.snapshot()
+    return PlainTextResponse(metrics.prometheus(), media_type="text/plain; version=0.0.4")
+
+# Queue depth, waiting time and inference time of the model worker
+@app.get("/inference_stats", tags=["movie"])
+async def inference_stats():
+    return inference.stats()
+
 # Main function to run the FastAPI application
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,133 @@
+import asyncio
+import importlib.util
+import json
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from frame_log import FrameLog, compact, read_frames  # noqa: E402
+
+
+def write_log(path, frames, tail=b""):
+    with FrameLog(path) as log:
+        for key, text in frames:
+            log.append(key, text)
+    with open(path, "ab") as f:
+        f.write(tail)
+
+
+@pytest.mark.parametrize("tail", [b'{"frame": "frame_2", "te', b"not json\n", b'{"frame": "frame_2"\n'])
+def test_bad_last_line_is_skipped_and_truncated(tmp_path, tail):
+    path = str(tmp_path / "frames.jsonl")
+    frames = [("frame_0", "a"), ("frame_1", "b")]
+    write_log(path, frames, tail)
+
+    assert list(read_frames(path)) == frames
+    clean_size = os.path.getsize(path) - len(tail)
+    FrameLog(path).close()
+    assert os.path.getsize(path) == clean_size
+    assert list(read_frames(path)) == frames
+
+
+def test_appends_after_reopen_start_on_a_clean_line(tmp_path):
+    path = str(tmp_path / "frames.jsonl")
+    write_log(path, [("frame_0", "a")], tail=b'{"frame": "frame_1", "text": "cut sh')
+    with FrameLog(path) as log:
+        log.append("frame_1", "b")
+        log.append("frame_2", "c")
+    assert list(read_frames(path)) == [("frame_0", "a"), ("frame_1", "b"), ("frame_2", "c")]
+
+
+def test_read_frames_of_missing_log(tmp_path):
+    assert list(read_frames(str(tmp_path / "missing.jsonl"))) == []
+
+
+def test_compact_matches_appended_frames(tmp_path):
+    log_path = str(tmp_path / "frames.jsonl")
+    json_path = str(tmp_path / "frames.json")
+    frames = [(f"frame_{i}", f"text {i}\nwith \"quotes\" and ünïcode") for i in range(25)]
+    write_log(log_path, frames)
+
+    assert compact(log_path, json_path) == dict(frames)
+    with open(json_path) as f:
+        assert json.load(f) == dict(frames)
+    assert not os.path.exists(json_path + ".tmp")
+
+
+@pytest.fixture
+def test19(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    spec = importlib.util.spec_from_file_location("test19_script", os.path.join(REPO_DIR, "test19.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    calls = []
+
+    async def construct_initial_prompt(topic):
+        calls.append(("initial", None))
+        return "new start"
+
+    async def generate_advanced_space_scene(job="default"):
+        return "scene"
+
+    async def continue_next_frame_generation(last_frames, job="default"):
+        calls.append(("next", last_frames[-1]))
+        return f"generated {len(calls)}"
+
+    monkeypatch.setattr(module, "construct_initial_prompt", construct_initial_prompt)
+    monkeypatch.setattr(module, "generate_advanced_space_scene", generate_advanced_space_scene)
+    monkeypatch.setattr(module, "continue_next_frame_generation", continue_next_frame_generation)
+    yield module, calls
+    module.inference.close()
+
+
+def saved_frames():
+    with open("dogs_movie_frames.json") as f:
+        return json.load(f)
+
+
+def test_resume_from_log_continues_at_first_missing_frame(test19):
+    module, calls = test19
+    old = [(f"frame_{i}", f"old {i}") for i in range(5)]
+    write_log("dogs_movie_frames.jsonl", old, tail=b'{"frame": "frame_5", "te')
+
+    asyncio.run(module.generate_movie_frames("dogs", "dogs", resume=True))
+
+    # No new opening; the first new frame follows on from frame_4
+    assert calls[0] == ("next", "old 4")
+    assert len(calls) == 500 - 5
+    frames = saved_frames()
+    assert len(frames) == 500
+    assert all(frames[key] == text for key, text in old)
+    assert frames["frame_5"] == "generated 1"
+    assert dict(read_frames("dogs_movie_frames.jsonl")) == frames
+
+
+def test_resume_from_frames_json_written_before_the_log(test19):
+    module, calls = test19
+    old = {f"frame_{i}": f"old {i}" for i in range(3)}
+    with open("dogs_movie_frames.json", "w") as f:
+        json.dump(old, f)
+
+    asyncio.run(module.generate_movie_frames("dogs", "dogs", resume=True))
+
+    assert calls[0] == ("next", "old 2")
+    frames = saved_frames()
+    assert len(frames) == 500
+    assert all(frames[key] == text for key, text in old.items())
+    assert frames["frame_3"] == "generated 1"
+
+
+def test_without_resume_starts_over(test19):
+    module, calls = test19
+    write_log("dogs_movie_frames.jsonl", [(f"frame_{i}", f"old {i}") for i in range(5)])
+
+    asyncio.run(module.generate_movie_frames("dogs", "dogs", resume=False))
+
+    assert calls[0] == ("initial", None)
+    frames = saved_frames()
+    assert frames["frame_0"] == "new start"
+    assert "old" not in "".join(frames.values())
@@ -0,0 +1,100 @@
+import asyncio
+import os
+import sys
+import threading
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "benchmarks"))
+
+from fake_sd import FakeSDServer  # noqa: E402
+from sd_client import SDError  # noqa: E402
+from sd_scheduler import SDScheduler  # noqa: E402
+
+PAYLOAD = {"prompt": "test", "width": 8, "height": 8}
+
+
+@pytest.fixture
+def fake_sd():
+    servers = []
+
+    def start(**kwargs):
+        server = FakeSDServer(("127.0.0.1", 0), latency=0.0, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_single_backend_retries_with_backoff(fake_sd):
+    server, url = fake_sd(failure_rate=0.3, seed=1)
+    scheduler = SDScheduler([url], retries=6, backoff=0.001)
+    try:
+        for _ in range(20):
+            assert len(scheduler.txt2img(PAYLOAD)["images"]) == 1
+    finally:
+        scheduler.close()
+    assert server.failures > 0
+    assert server.requests == 20 + server.failures
+
+
+def test_gives_up_after_retries(fake_sd):
+    server, url = fake_sd(failure_rate=1.0)
+    scheduler = SDScheduler([url], retries=2, backoff=0.001)
+    try:
+        with pytest.raises(SDError) as error:
+            scheduler.txt2img(PAYLOAD)
+    finally:
+        scheduler.close()
+    assert error.value.status_code == 503
+    assert server.requests == 3
+
+
+def test_fails_over_and_benches_broken_backend(fake_sd):
+    broken, broken_url = fake_sd(failure_rate=1.0)
+    healthy, healthy_url = fake_sd()
+    scheduler = SDScheduler([broken_url, healthy_url], max_failures=2, cooldown=60.0, backoff=0.001)
+    try:
+        for _ in range(10):
+            scheduler.txt2img(PAYLOAD)
+        stats = {backend["url"]: backend for backend in scheduler.stats()}
+    finally:
+        scheduler.close()
+    # Benched after two failures in a row, so no jobs reach it during the cooldown
+    assert broken.requests == 2
+    assert healthy.requests == 10
+    assert not stats[broken_url]["healthy"]
+    assert stats[healthy_url]["completed"] == 10
+
+
+def test_async_retries(fake_sd):
+    server, url = fake_sd(failure_rate=0.3, seed=2)
+    scheduler = SDScheduler([url], retries=6, backoff=0.001)
+
+    async def run():
+        return await asyncio.gather(*(scheduler.atxt2img(PAYLOAD) for _ in range(10)))
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        scheduler.close()
+    assert all(len(result["images"]) == 1 for result in results)
+    assert server.requests == 10 + server.failures
+
+
+def test_bad_payload_is_not_retried(fake_sd):
+    server, url = fake_sd()
+    scheduler = SDScheduler([url], backoff=0.001)
+    try:
+        with pytest.raises(SDError) as error:
+            scheduler.post("/sdapi/v1/unknown", PAYLOAD)
+    finally:
+        scheduler.close()
+    assert error.value.status_code == 404
+    assert server.requests == 0
@@ -0,0 +1,118 @@
+import os
+import subprocess
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from metrics import metrics
+from sd_images import SDImage
+
+
+def ffmpeg_exe():
+    # moviepy ships an ffmpeg binary through imageio-ffmpeg; fall back to PATH
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except ImportError:
+        return "ffmpeg"
+
+
+# "30s", "2m", "1hr" or a plain number of seconds
+def parse_duration(duration):
+    duration = str(duration).strip().lower()
+    for suffix, scale in (("hr", 3600), ("h", 3600), ("m", 60), ("s", 1)):
+        if duration.endswith(suffix):
+            return float(duration[:-len(suffix)]) * scale
+    return float(duration)
+
+
+class FFmpegVideoSink:
+    """Encode frames to a video as they are produced.
+
+    Frames (PIL images or HxWx3 uint8 arrays) are piped straight into an ffmpeg
+    process, so nothing is held in memory beyond the frame being written. When
+    `png_pattern` is set (e.g. "frames/{}.png"), every `png_every`-th frame is
+    also saved to disk, named after `index` when one is passed to `write`; with
+    a `png_writer` (a `PNGWriter`) the saves happen in the background. Frames
+    passed as `SDImage`s are saved from the PNG bytes SD sent.
+    """
+
+    def __init__(self, path, fps=24, codec="libx264", png_pattern=None, png_every=0, png_writer=None):
+        self.path = path
+        self.fps = fps
+        self.codec = codec
+        self.png_pattern = png_pattern
+        self.png_every = png_every
+        self.png_writer = png_writer
+        self.frames_written = 0
+        self.size = None
+        self.process = None
+        self._stderr = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _start(self, width, height):
+        self.size = (width, height)
+        self._stderr = tempfile.TemporaryFile()
+        command = [
+            ffmpeg_exe(), "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(self.fps), "-i", "-",
+            # yuv420p needs even dimensions
+            "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+            "-c:v", self.codec, "-pix_fmt", "yuv420p", self.path,
+        ]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=self._stderr)
+
+    def write(self, frame, index=None, save=True):
+        encoded = frame if isinstance(frame, SDImage) else None
+        if encoded is not None:
+            frame = encoded.image
+        if isinstance(frame, Image.Image):
+            image = frame if frame.mode == "RGB" else frame.convert("RGB")
+        else:
+            image = Image.fromarray(np.asarray(frame, dtype=np.uint8)).convert("RGB")
+        if self.process is None:
+            self._start(*image.size)
+        elif image.size != self.size:
+            image = image.resize(self.size, Image.LANCZOS)
+            encoded = None
+
+        index = self.frames_written if index is None else index
+        png_path = None
+        if save and self.png_pattern and self.png_every and index % self.png_every == 0:
+            png_path = self.png_pattern.format(index)
+            source = encoded if encoded is not None else image
+            if self.png_writer is not None:
+                self.png_writer.write(png_path, source)
+            else:
+                source.save(png_path)
+
+        try:
+            with metrics.timer("video_write"):
+                self.process.stdin.write(image.tobytes())
+        except BrokenPipeError:
+            self.close()
+        self.frames_written += 1
+        metrics.inc("video_frames")
+        return png_path
+
+    def close(self):
+        if self.process is None:
+            return
+        process, self.process = self.process, None
+        with metrics.timer("video_finish"):
+            if not process.stdin.closed:
+                process.stdin.close()
+            returncode = process.wait()
+        self._stderr.seek(0)
+        errors = self._stderr.read().decode(errors="replace")
+        self._stderr.close()
+        if returncode != 0:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            raise RuntimeError(f"ffmpeg exited with {returncode}: {errors.strip()}")